@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''flexicomps
+
+Copyright (C) 2008-2010
+    Geoffrey Biggs
+    RT-Synthesis Research Group
+    Intelligent Systems Research Institute,
+    National Institute of Advanced Industrial Science and Technology (AIST),
+    Japan
+    All rights reserved.
+Licensed under the Eclipse Public License -v 1.0 (EPL)
+http://www.opensource.org/licenses/eclipse-1.0.txt
+
+File: flexitime.py
+
+Time handling shared by the FlexiComps components. Times are held internally as
+integer nanoseconds, so comparisons and arithmetic are single integer
+operations. Conversion to and from RTC.Time is only done when data passes
+through a port.
+
+'''
+
+import ctypes
+import sys
+import time
+
+import RTC
+
+
+NSEC_PER_SEC = 1000000000
+
+
+def time_to_ns(time_val):
+    return time_val.sec * NSEC_PER_SEC + time_val.nsec
+
+
+def ns_to_time(ns, time_val=None):
+    '''Converts a time in nanoseconds to an RTC.Time. If time_val is given, it
+    is filled in and returned instead of creating a new RTC.Time.
+
+    '''
+    sec, nsec = divmod(ns, NSEC_PER_SEC)
+    if time_val is None:
+        return RTC.Time(sec, nsec)
+    time_val.sec = sec
+    time_val.nsec = nsec
+    return time_val
+
+
+def float_to_ns(float_val):
+    # Convert the whole and fractional seconds separately to avoid losing
+    # the nanoseconds of large times to the precision of the float
+    sec = int(float_val)
+    return sec * NSEC_PER_SEC + int(round((float_val - sec) * NSEC_PER_SEC))
+
+
+def ns_to_float(ns):
+    sec, nsec = divmod(ns, NSEC_PER_SEC)
+    return sec + nsec / 1e9
+
+
+def now_ns():
+    return float_to_ns(time.time())
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _get_monotonic_ns():
+    # Python 2 has no monotonic clock, so use clock_gettime directly where it
+    # is known to be available, and fall back to the wall clock elsewhere
+    if hasattr(time, 'monotonic'):
+        return lambda: float_to_ns(time.monotonic())
+    if not sys.platform.startswith('linux'):
+        return now_ns
+    clock_gettime = None
+    for lib_name in ['librt.so.1', 'libc.so.6']:
+        try:
+            clock_gettime = ctypes.CDLL(lib_name).clock_gettime
+            break
+        except (OSError, AttributeError):
+            pass
+    if clock_gettime is None:
+        return now_ns
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+    CLOCK_MONOTONIC = 1
+
+    def monotonic_ns():
+        ts = _Timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            raise OSError('clock_gettime failed')
+        return ts.tv_sec * NSEC_PER_SEC + ts.tv_nsec
+    return monotonic_ns
+
+
+# Gets the time in nanoseconds from a clock that is not affected by changes
+# to the system time. Only differences between its values are meaningful.
+monotonic_ns = _get_monotonic_ns()
+
+
+def format_ns(ns):
+    sec, nsec = divmod(ns, NSEC_PER_SEC)
+    return '{0}.{1:09d}'.format(sec, nsec)
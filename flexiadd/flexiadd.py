@@ -19,8 +19,12 @@ FlexiAdd component.
 
 '''
 
+from collections import deque
 import inspect
+import math
+import operator
 from optparse import OptionParser, OptionError
+import os
 import pickle
 import re
 import sys
@@ -29,10 +33,26 @@ from traceback import print_exception
 import OpenRTM_aist
 import RTC
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The modules shared between components are kept in the common directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'common'))
+import flexitime
+
 
 # Globals set by command line options
 ports = []
 verbosity = 0
+incremental = False
+renormalise = 100
+reduction = 'sum'
+weights = []
+syncTolerance = None
+syncDepth = 8
 flexiadd_spec = ['implementation_id', 'FlexiAdd',
                 'type_name',          'FlexiAdd',
                 'description',        'Flexible data addition component',
@@ -45,6 +65,182 @@ flexiadd_spec = ['implementation_id', 'FlexiAdd',
                 'lang_type',          'SCRIPT',
                 '']
 
+# The NumPy function and the element function used to combine the data of each
+# port for each reduction
+arrayReductions = {'sum': 'add', 'weighted': 'add', 'mean': 'add',
+                   'min': 'minimum', 'max': 'maximum', 'product': 'multiply',
+                   'norm': 'add'}
+listReductions = {'sum': operator.add, 'weighted': operator.add,
+                  'mean': operator.add, 'min': min, 'max': max,
+                  'product': operator.mul, 'norm': operator.add}
+
+
+class Accumulator(object):
+    '''Reduces data from several ports to one value: their sum, weighted sum
+    (with a weight for each port), mean, minimum, maximum, product or L2 norm.
+    Sequences are reduced element-wise. With NumPy, sequences are reduced into
+    an accumulator array that is kept between calls, so no new array is needed
+    unless the length or type of the sequences changes. Without NumPy, the
+    sequences are reduced with map(), which runs the loop over the elements in
+    C. Scalars are reduced in the same way as sequences of one element.
+
+    The total is kept after each reduction, so that sums, weighted sums and
+    means can be updated with only the data that has changed. Floating-point
+    totals are recalculated in full after every renormalise updates to stop
+    rounding errors building up; integer totals are exact and are never
+    recalculated. The weighted sum, mean and L2 norm of integer data are
+    rounded to the nearest integer.
+
+    '''
+    def __init__(self, reduction='sum', weights=None, renormalise=100):
+        self.__reduction = reduction
+        self.__weights = weights
+        self.__renormalise = renormalise
+        self.__acc = None
+        self.__scratch = None
+        self.__total = None
+        self.__updates = 0
+
+    def reduce(self, items):
+        '''Reduces the data in items, a list of (port number, data) pairs, and
+        keeps the total.
+
+        '''
+        self.__total = None
+        self.__updates = 0
+        self.__count = len(items)
+        self.__scalar = type(items[0][1]) != list
+        if self.__scalar:
+            items = [(port, [data]) for port, data in items]
+        length = len(items[0][1])
+        for port, data in items[1:]:
+            if len(data) != length:
+                raise ValueError('Cannot reduce sequences of different \
+lengths: %d and %d' % (length, len(data)))
+        if numpy is None or self.__scalar:
+            self.__integer = length > 0 and type(items[0][1][0]) in (int, long)
+            self.__total = self.__reduceLists(items)
+        else:
+            self.__total = self.__reduceArrays(items)
+        return self.__finish(self.__total)
+
+    def update(self, items, changes):
+        '''Updates the total from the last call with changes, a list of (port
+        number, old data, new data) tuples, where the old data is None if the
+        port had no data before. items is the current data of all ports, which
+        is reduced in full if the total cannot be updated.
+
+        '''
+        if self.__total is None or \
+                self.__reduction not in ('sum', 'weighted', 'mean'):
+            return self.reduce(items)
+        if self.__scalar:
+            changes = [(port, old, new) if type(new) == list else \
+                       (port, old if old is None else [old], [new]) \
+                       for port, old, new in changes]
+        if not self.__canUpdate(changes):
+            return self.reduce(items)
+        if self.__isFloat():
+            self.__updates += 1
+            if self.__updates >= self.__renormalise:
+                return self.reduce(items)
+        self.__count = len(items)
+        if self.__acc is not None:
+            for port, old, new in changes:
+                for data, ufunc in ((new, numpy.add), (old, numpy.subtract)):
+                    if data is not None:
+                        ufunc(self.__acc, self.__arrayTerm(port, data),
+                              out=self.__acc, casting='unsafe')
+        else:
+            for port, old, new in changes:
+                for data, op in ((new, operator.add), (old, operator.sub)):
+                    if data is not None:
+                        self.__total = map(op, self.__total,
+                                           self.__listTerm(port, data))
+        return self.__finish(self.__total)
+
+    def __reduceArrays(self, items):
+        first = numpy.asarray(items[0][1])
+        self.__integer = first.dtype.kind in 'iu'
+        if self.__reduction in ('weighted', 'norm'):
+            dtype = numpy.float64
+        else:
+            dtype = first.dtype
+        if self.__acc is None or self.__acc.shape != first.shape or \
+                self.__acc.dtype != dtype:
+            self.__acc = numpy.empty(first.shape, dtype)
+            self.__scratch = numpy.empty(first.shape, dtype)
+        self.__acc[:] = self.__arrayTerm(items[0][0], first)
+        ufunc = getattr(numpy, arrayReductions[self.__reduction])
+        for port, data in items[1:]:
+            ufunc(self.__acc, self.__arrayTerm(port, data), out=self.__acc,
+                  casting='unsafe')
+        return self.__acc
+
+    def __arrayTerm(self, port, data):
+        # Weighted sums and norms add up a function of each port's data, which
+        # is placed in the scratch array
+        if self.__reduction == 'weighted':
+            numpy.multiply(data, self.__weights[port], out=self.__scratch,
+                           casting='unsafe')
+            return self.__scratch
+        elif self.__reduction == 'norm':
+            data = numpy.asarray(data)
+            numpy.multiply(data, data, out=self.__scratch, casting='unsafe')
+            return self.__scratch
+        return data
+
+    def __reduceLists(self, items):
+        self.__acc = None
+        op = listReductions[self.__reduction]
+        total = self.__listTerm(*items[0])
+        for port, data in items[1:]:
+            total = map(op, total, self.__listTerm(port, data))
+        return list(total)
+
+    def __listTerm(self, port, data):
+        if self.__reduction == 'weighted':
+            return map(float(self.__weights[port]).__mul__, data)
+        elif self.__reduction == 'norm':
+            return map(operator.mul, data, data)
+        return data
+
+    def __finish(self, total):
+        '''Makes the result from the total, without changing the total.'''
+        if self.__acc is not None:
+            if self.__reduction == 'mean':
+                total = numpy.divide(total, float(self.__count))
+            elif self.__reduction == 'norm':
+                total = numpy.sqrt(total)
+            if self.__integer and self.__reduction in ('weighted', 'mean',
+                                                       'norm'):
+                # Round halves away from zero, as round() does without NumPy
+                total = (numpy.sign(total) * \
+                         numpy.floor(numpy.abs(total) + 0.5)).astype(numpy.int64)
+            return total.tolist()
+        if self.__reduction == 'mean':
+            total = map(operator.truediv, total,
+                        [float(self.__count)] * len(total))
+        elif self.__reduction == 'norm':
+            total = map(math.sqrt, total)
+        if self.__integer and self.__reduction in ('weighted', 'mean', 'norm'):
+            total = map(int, map(round, total))
+        if self.__scalar:
+            return total[0]
+        return total
+
+    def __canUpdate(self, changes):
+        for port, old, new in changes:
+            if type(new) != list or len(new) != len(self.__total) or \
+                    (old is not None and len(old) != len(new)):
+                return False
+        return True
+
+    def __isFloat(self):
+        if self.__acc is not None:
+            return self.__acc.dtype.kind == 'f'
+        return len(self.__total) > 0 and type(self.__total[0]) == float
+
 
 class FlexiAdd(OpenRTM_aist.DataFlowComponentBase):
     def __init__(self, manager):
@@ -56,6 +252,7 @@ class FlexiAdd(OpenRTM_aist.DataFlowComponentBase):
             # port object)
             self.__inPorts = []
             self.__inPortBuffers = []
+            self.__accumulator = Accumulator(reduction, weights, renormalise)
 
             newPort = ports[0]
             for ii in range(newPort[2]):
@@ -65,6 +262,11 @@ class FlexiAdd(OpenRTM_aist.DataFlowComponentBase):
                 self.registerInPort('input%d' % ii, newInPort)
                 self.__inPorts.append([newInPortData, newInPort])
                 self.__inPortBuffers.append(None)
+            if syncTolerance is not None:
+                self.__syncTolerance = flexitime.float_to_ns(syncTolerance)
+                self.__syncQueues = [deque(maxlen=syncDepth) \
+                                     for ii in range(newPort[2])]
+                self.__evicted = [0 for ii in range(newPort[2])]
 
             self.__outPortData = newPort[1](RTC.Time(0, 0), [])
             self.__outPort = OpenRTM_aist.OutPort('output', self.__outPortData,
@@ -75,36 +277,83 @@ class FlexiAdd(OpenRTM_aist.DataFlowComponentBase):
             return RTC.RTC_ERROR
         return RTC.RTC_OK
 
+    def onDeactivated(self, ec_id):
+        if syncTolerance is not None:
+            if verbosity >= 1:
+                print 'Samples evicted without a match: ' + \
+                        ', '.join(['input%d: %d' % (ii, count) \
+                                   for ii, count in enumerate(self.__evicted)])
+            for queue in self.__syncQueues:
+                queue.clear()
+        return RTC.RTC_OK
+
     def onExecute(self, ec_id):
         try:
-            newData = False
-            newTime =(0, 0)
-            for ii, port in enumerate(self.__inPorts):
-                if port[1].isNew():
-                    newData = True
-                    data = port[1].read()
-                    self.__inPortBuffers[ii] = data.data
-                    newTime =(data.tm.sec, data.tm.nsec)
-            if newData:
-                if type(self.__inPortBuffers[0]) == list:
-                    result = [0 for ii in range(len(self.__inPortBuffers[0]))]
-                    for ii in range(len(self.__inPortBuffers[0])):
-                        for portBuffer in self.__inPortBuffers:
-                            if portBuffer != None:
-                                result[ii] += portBuffer[ii]
-                else:
-                    result = 0
-                    for portBuffer in self.__inPortBuffers:
-                        result += portBuffer
-
-                self.__outPortData.data = result
-                self.__outPortData.tm.sec = newTime[0]
-                self.__outPortData.tm.nsec = newTime[1]
-                self.__outPort.write()
+            if syncTolerance is None:
+                self.__addLatest()
+            else:
+                self.__addAligned()
         except:
             print_exception(*sys.exc_info())
         return RTC.RTC_OK
 
+    def __addLatest(self):
+        '''Adds the most recent data of each port whenever any port has new
+        data.
+
+        '''
+        changes = []
+        newTime = 0
+        for ii, port in enumerate(self.__inPorts):
+            if port[1].isNew():
+                data = port[1].read()
+                changes.append((ii, self.__inPortBuffers[ii], data.data))
+                self.__inPortBuffers[ii] = data.data
+                newTime = flexitime.time_to_ns(data.tm)
+        if changes:
+            # Ports that have not received data yet are left out
+            items = [(ii, portBuffer) for ii, portBuffer in \
+                     enumerate(self.__inPortBuffers) if portBuffer is not None]
+            if incremental:
+                result = self.__accumulator.update(items, changes)
+            else:
+                result = self.__accumulator.reduce(items)
+            self.__writeResult(result, newTime)
+
+    def __addAligned(self):
+        '''Adds samples only when every port has a sample within the sync
+        tolerance of the others. The output is given the time of the newest
+        sample in the sum.
+
+        '''
+        for ii, port in enumerate(self.__inPorts):
+            queue = self.__syncQueues[ii]
+            while port[1].isNew():
+                data = port[1].read()
+                if len(queue) == queue.maxlen:
+                    self.__evicted[ii] += 1
+                queue.append((flexitime.time_to_ns(data.tm), data.data))
+        while all(self.__syncQueues):
+            newest = max([queue[0][0] for queue in self.__syncQueues])
+            # Samples too old to be matched with the newest of the oldest
+            # samples can never be matched, as later samples are newer still
+            for ii, queue in enumerate(self.__syncQueues):
+                while queue and queue[0][0] < newest - self.__syncTolerance:
+                    queue.popleft()
+                    self.__evicted[ii] += 1
+            if not all(self.__syncQueues) or \
+                    max([queue[0][0] for queue in self.__syncQueues]) != newest:
+                continue
+            samples = [queue.popleft() for queue in self.__syncQueues]
+            result = self.__accumulator.reduce([(ii, sample[1]) for ii, sample \
+                                                in enumerate(samples)])
+            self.__writeResult(result, newest)
+
+    def __writeResult(self, result, newTime):
+        self.__outPortData.data = result
+        flexitime.ns_to_time(newTime, self.__outPortData.tm)
+        self.__outPort.write()
+
 
 def MyModuleInit(manager):
     profile = OpenRTM_aist.Properties(defaults_str = flexiadd_spec)
@@ -126,7 +375,8 @@ def FindPortType(typeName):
 
 
 def GetPortOptions():
-    global ports, verbosity
+    global ports, verbosity, incremental, renormalise, reduction, weights, \
+           syncTolerance, syncDepth
 
     try:
         usage = 'usage: %prog [options]\nAdd multiple data streams together \
@@ -136,10 +386,38 @@ to produce a single output.'
                           action = 'append', default = [],
                           help = 'Port type and number of times to add. e.g. \
 "TimedFloatSeq:4"')
+        parser.add_option('-w', '--weight', dest = 'weights',
+                          type = 'float', action = 'append', default = [],
+                          help = 'Weight of a port in a weighted sum. Give one \
+weight for each port, in port order.')
         parser.add_option('-v', '--verbosity', dest = 'verbosity',
                           type = 'int', default = 0,
                           help = 'Verbosity level (higher numbers give more \
 output). [Default: %default]')
+        parser.add_option('-i', '--incremental', dest = 'incremental',
+                          action = 'store_true', default = False,
+                          help = 'Keep a running total, and update it with only \
+the data that has changed. [Default: %default]')
+        parser.add_option('--renormalise', dest = 'renormalise', type = 'int',
+                          default = 100,
+                          help = 'Number of incremental updates of a \
+floating-point total between full sums. [Default: %default]')
+        parser.add_option('-r', '--reduction', dest = 'reduction',
+                          type = 'choice',
+                          choices = sorted(arrayReductions.keys()),
+                          default = 'sum',
+                          help = 'How to combine the data of the ports: sum, \
+weighted (sum), mean, min, max, product or norm (L2 norm). [Default: \
+%default]')
+        parser.add_option('-s', '--sync', dest = 'syncTolerance',
+                          type = 'float', default = None,
+                          help = 'Only add samples with times within this many \
+seconds of each other, one sample from each port. [Default: add the latest \
+data of each port]')
+        parser.add_option('--sync_depth', dest = 'syncDepth', type = 'int',
+                          default = 8,
+                          help = 'Number of samples of each port held while \
+waiting for a match in sync mode. [Default: %default]')
         options, args = parser.parse_args()
     except OptionError, e:
         print 'OptionError: ' + str(e)
@@ -149,6 +427,26 @@ output). [Default: %default]')
         parser.error('Must specify at least one port')
 
     verbosity = options.verbosity
+    if options.syncTolerance is not None and options.syncTolerance < 0:
+        parser.error('Sync tolerance must not be negative')
+    if options.syncDepth < 1:
+        parser.error('Sync depth must be at least 1')
+    if options.renormalise < 1:
+        parser.error('Renormalise period must be at least 1')
+    if options.incremental and options.syncTolerance is not None:
+        parser.error('Incremental updates cannot be used in sync mode')
+    if options.incremental and \
+            options.reduction not in ('sum', 'weighted', 'mean'):
+        parser.error('Incremental updates can only be used with the sum, \
+weighted and mean reductions')
+    if options.weights and options.reduction != 'weighted':
+        parser.error('Weights can only be used with the weighted reduction')
+    reduction = options.reduction
+    weights = options.weights
+    incremental = options.incremental
+    renormalise = options.renormalise
+    syncTolerance = options.syncTolerance
+    syncDepth = options.syncDepth
 
     for portStr in options.ports:
         fields = portStr.split(':')
@@ -163,6 +461,10 @@ output). [Default: %default]')
         if verbosity >= 2:
             print 'Added port: ' + str(portInfo)
 
+    if reduction == 'weighted' and len(weights) != ports[0][2]:
+        parser.error('Weighted reduction needs one weight for each of the %d \
+ports' % ports[0][2])
+
     # Strip the options we use from sys.argv to avoid confusing the
     # manager's option parser
     sys.argv = [option for option in sys.argv \
@@ -20,14 +20,19 @@ FlexiConst component.
 
 import imp
 import inspect
+import os
 import sys
 from traceback import print_exc
-from time import time
 from optparse import OptionParser, OptionError
 
 import OpenRTM_aist
 import RTC
 
+# The modules shared between components are kept in the common directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir, 'common'))
+import flexitime
+
 
 class FlexiConst(OpenRTM_aist.DataFlowComponentBase):
     def __init__(self, mgr, const, port, mods, verb=0):
@@ -47,6 +52,8 @@ class FlexiConst(OpenRTM_aist.DataFlowComponentBase):
             else:
                 init_args = [None for ii in range(len(args) - 1)]
             self._out_data = self._port[1](*init_args)
+            if 'tm' in dir(self._out_data):
+                self._out_data.tm = RTC.Time(0, 0)
             self._outport = OpenRTM_aist.OutPort('output', self._out_data,
                     OpenRTM_aist.RingBuffer(8))
             self.registerOutPort('output', self._outport)
@@ -58,8 +65,7 @@ class FlexiConst(OpenRTM_aist.DataFlowComponentBase):
     def onExecute(self, ec_id):
         try:
             if 'tm' in dir(self._out_data):
-                now = time()
-                self._out_data.tm = RTC.Time(int(now), int((now % 1) * 1e9))
+                flexitime.ns_to_time(flexitime.now_ns(), self._out_data.tm)
                 if 'data' in dir(self._out_data):
                     self._out_data.data = self._const
                 self._outport.write()
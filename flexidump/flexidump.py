@@ -18,26 +18,389 @@ FlexiDump component.
 '''
 
 
+import collections
+import cPickle as pickle
+import csv
 import imp
 import inspect
+import json
+import math
 import optparse
+import os
+import struct
 import sys
+import time
 import traceback
 
 import OpenRTM_aist
 import RTC
 
+# The modules shared between components are kept in the common directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir, 'common'))
+import flexitime
+
+
+class BufferedOutput(object):
+    '''Collects output in memory and writes it out in one go when enough has
+    built up or when flush_interval seconds have passed since the last write,
+    rather than flushing for every sample.
+
+    '''
+    def __init__(self, out, flush_interval=0.5, max_size=65536):
+        self._out = out
+        self._flush_interval = flush_interval
+        self._max_size = max_size
+        self._parts = []
+        self._size = 0
+        self._last_flush = time.time()
+
+    def write(self, s):
+        self._parts.append(s)
+        self._size += len(s)
+        if self._size >= self._max_size:
+            self.flush()
+
+    def check(self):
+        '''Flushes the output if the flush interval has passed.'''
+        if self._parts and \
+                time.time() - self._last_flush >= self._flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self._parts:
+            self._out.write(''.join(self._parts))
+            self._parts = []
+            self._size = 0
+        self._out.flush()
+        self._last_flush = time.time()
+
+
+# Names of the fields of each struct class, in declaration order
+_struct_fields = {}
+
+
+def struct_fields(value):
+    '''Gets the names of the fields of a struct, in the order of its
+    constructor's arguments where possible.
+
+    '''
+    cls = value.__class__
+    if cls not in _struct_fields:
+        names = sorted([k for k in value.__dict__ if not k.startswith('_')])
+        try:
+            args = inspect.getargspec(cls.__init__)[0][1:]
+            if sorted(args) == names:
+                names = args
+        except TypeError:
+            pass
+        _struct_fields[cls] = names
+    return _struct_fields[cls]
+
+
+def to_plain(value):
+    '''Converts a value to lists, dictionaries and basic types for JSON.
+    NaN and infinite values, which JSON cannot represent, become None.
+
+    '''
+    if isinstance(value, str):
+        # Strings are also used for byte sequences, which may not be UTF-8
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return value.decode('latin-1')
+    elif isinstance(value, (list, tuple)):
+        return [to_plain(v) for v in value]
+    elif hasattr(value, '__dict__'):
+        return dict([(f, to_plain(getattr(value, f))) \
+                for f in struct_fields(value)])
+    elif isinstance(value, float):
+        if math.isnan(value) or math.isinf(value):
+            return None
+        return value
+    elif value is None or isinstance(value, (bool, int, long)):
+        return value
+    return str(value)
+
+
+def flatten(value, out):
+    '''Appends the basic values in a value to out, with sequences and structs
+    expanded into their elements.
+
+    '''
+    if isinstance(value, (list, tuple)):
+        for v in value:
+            flatten(v, out)
+    elif hasattr(value, '__dict__'):
+        for f in struct_fields(value):
+            flatten(getattr(value, f), out)
+    else:
+        out.append(value)
+    return out
+
+
+def data_value(data):
+    # Gets the value of a sample, without its time
+    if hasattr(data, 'data') and hasattr(data, 'tm'):
+        return data.data
+    elif hasattr(data, '__dict__'):
+        return dict([(f, getattr(data, f)) for f in struct_fields(data) \
+                if f != 'tm'])
+    return data
+
+
+def evaluate(code, sample):
+    '''Evaluates a compiled port expression for a sample. The sample is
+    available to the expression as sample, its data as data, and its time as
+    tm.
+
+    '''
+    return eval(code, {}, {'sample': sample,
+        'data': getattr(sample, 'data', sample),
+        'tm': getattr(sample, 'tm', None)})
+
+
+def data_time(data):
+    if hasattr(data, 'tm'):
+        return flexitime.time_to_ns(data.tm)
+    return flexitime.now_ns()
+
+
+class Dumper(object):
+    '''Base class of the output formats. If a port has a projection, a
+    compiled expression, only the result of the expression is output for its
+    samples.
+
+    '''
+    def __init__(self, out, verb, port_spec, projections={}):
+        self._out = out
+        self._verb = verb
+        self._projections = projections
+        self._failed = set()
+        self._port_names = [p[2] or 'input' + str(ii) \
+                for ii, p in enumerate(port_spec)]
+        # Ports whose data is a string of bytes rather than of text
+        self._byte_ports = set([ii for ii, p in enumerate(port_spec) \
+                if p[0] == 'TimedOctetSeq'])
+
+    def _value(self, port_num, data, byte_lists=True):
+        # Gets the value of a sample, or its projection, with byte strings as
+        # lists of numbers if byte_lists is True
+        if port_num in self._projections:
+            try:
+                return evaluate(self._projections[port_num], data)
+            except Exception, e:
+                if port_num not in self._failed:
+                    print >>sys.stderr, 'Error in projection of port \
+{0}: {1}'.format(self._port_names[port_num], e)
+                    self._failed.add(port_num)
+                return None
+        value = data_value(data)
+        if byte_lists and port_num in self._byte_ports:
+            return list(bytearray(value))
+        return value
+
+    def check(self):
+        '''Called once per execution.'''
+        pass
+
+
+class TextDumper(Dumper):
+    def dump(self, port_num, port_name, data):
+        if self._verb == -1:
+            self._out.write('Input port {0} has new data\n'.format(port_name))
+        else:
+            if port_num in self._projections:
+                data = self._value(port_num, data)
+            self._out.write('Input port {0} has new data: {1}\n'.format(
+                port_name, data))
+
+
+class JsonDumper(Dumper):
+    '''One JSON object per line, with the port name, the time in nanoseconds
+    and the data.
+
+    '''
+    def dump(self, port_num, port_name, data):
+        self._out.write(json.dumps({'port': port_name,
+            'time': data_time(data),
+            'data': to_plain(self._value(port_num, data))},
+            separators=(',', ':'), allow_nan=False))
+        self._out.write('\n')
+
+
+class CsvDumper(Dumper):
+    '''One row per sample: the port name, the time in seconds, and the data
+    with sequences and structs flattened into one column per element.
+
+    '''
+    def __init__(self, out, verb, port_spec, projections={}):
+        Dumper.__init__(self, out, verb, port_spec, projections)
+        self._writer = csv.writer(out)
+
+    def dump(self, port_num, port_name, data):
+        row = [port_name, flexitime.format_ns(data_time(data))]
+        self._writer.writerow(flatten(self._value(port_num, data), row))
+
+
+class BinaryDumper(Dumper):
+    '''Length-prefixed records. Each record is the length of the rest of the
+    record (32 bits), the port number (16 bits), the time in nanoseconds (64
+    bits) and a payload type character, all little-endian, followed by the
+    payload:
+
+     'd' - float64 values
+     'q' - int64 values
+     's' - a string
+     'p' - a pickled value
+
+    '''
+    header = struct.Struct('<IHqc')
+
+    def dump(self, port_num, port_name, data):
+        value = self._value(port_num, data, byte_lists=False)
+        if isinstance(value, str):
+            kind, payload = 's', value
+        else:
+            if isinstance(value, (list, tuple)):
+                values = value
+            else:
+                values = [value]
+            if all(isinstance(v, float) for v in values):
+                kind = 'd'
+            elif all(isinstance(v, (int, long)) and \
+                    not isinstance(v, bool) for v in values):
+                kind = 'q'
+            else:
+                kind = 'p'
+            if kind == 'p':
+                payload = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            else:
+                try:
+                    payload = struct.pack('<{0}{1}'.format(len(values), kind),
+                            *values)
+                except struct.error:
+                    # Integers too large for 64 bits
+                    kind = 'p'
+                    payload = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self._out.write(self.header.pack(self.header.size - 4 + len(payload),
+            port_num, data_time(data), kind))
+        self._out.write(payload)
+
+
+class PortStats(object):
+    '''Rolling statistics of the samples received on a port. The intervals
+    between samples and the ages of the samples are kept for the last window
+    samples only, so memory use is constant.
+
+    '''
+    def __init__(self, window):
+        self.intervals = collections.deque(maxlen=window)
+        self.ages = collections.deque(maxlen=window)
+        self.count = 0
+        self._last_arrival = None
+
+    def add(self, arrival, age):
+        if self._last_arrival is not None:
+            self.intervals.append(arrival - self._last_arrival)
+        self._last_arrival = arrival
+        if age is not None:
+            self.ages.append(age)
+        self.count += 1
+
+
+def percentile(values, fraction):
+    # The nearest-rank percentile of some values
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(fraction * len(ordered))) - 1)]
+
+
+class StatsDumper(Dumper):
+    '''Prints a table of the rate, the intervals between samples and the ages
+    of the samples (the time they are read minus their time stamp) of each
+    port once per second, instead of the samples themselves.
+
+    '''
+    row = '{0:<16}{1:>8}{2:>9}{3:>9}{4:>9}{5:>9}{6:>9}{7:>9}{8:>9}\n'
+
+    def __init__(self, out, verb, port_spec, projections={}, window=1000):
+        Dumper.__init__(self, out, verb, port_spec, projections)
+        self._stats = {}
+        self._names = {}
+        self._window = window
+        self._last_report = flexitime.monotonic_ns()
+
+    def dump(self, port_num, port_name, data):
+        if port_num not in self._stats:
+            self._stats[port_num] = PortStats(self._window)
+            self._names[port_num] = port_name
+        if hasattr(data, 'tm'):
+            age = flexitime.now_ns() - flexitime.time_to_ns(data.tm)
+        else:
+            age = None
+        self._stats[port_num].add(flexitime.monotonic_ns(), age)
+
+    def check(self):
+        now = flexitime.monotonic_ns()
+        elapsed = now - self._last_report
+        if elapsed < flexitime.NSEC_PER_SEC:
+            return
+        self._last_report = now
+        self._out.write(self.row.format('Port', 'Count', 'Rate/s', 'Min ms',
+            'Mean ms', 'Max ms', 'P99 ms', 'Age ms', 'Max age'))
+        for port_num in sorted(self._stats):
+            stats = self._stats[port_num]
+            rate = stats.count * float(flexitime.NSEC_PER_SEC) / elapsed
+            fields = [self._names[port_num], stats.count,
+                    '{0:.1f}'.format(rate)]
+            if stats.intervals:
+                ints = stats.intervals
+                fields += ['{0:.3f}'.format(x / 1e6) for x in [min(ints),
+                    float(sum(ints)) / len(ints), max(ints),
+                    percentile(ints, 0.99)]]
+            else:
+                fields += ['-'] * 4
+            if stats.ages:
+                fields += ['{0:.3f}'.format(x / 1e6) for x in
+                    [float(sum(stats.ages)) / len(stats.ages),
+                        max(stats.ages)]]
+            else:
+                fields += ['-'] * 2
+            self._out.write(self.row.format(*fields))
+            stats.count = 0
+        self._out.write('\n')
+        self._out.flush()
+
+
+dumpers = {
+    'text':     TextDumper,
+    'json':     JsonDumper,
+    'csv':      CsvDumper,
+    'binary':   BinaryDumper,
+    'stats':    StatsDumper,
+}
+
 
 class FlexiDump (OpenRTM_aist.DataFlowComponentBase):
-    def __init__ (self, mgr, port_spec, verb=0):
+    def __init__ (self, mgr, port_spec, verb=0, buffer_depth=8,
+            out_format='text', flush_interval=0.5, projections={},
+            filters={}):
         OpenRTM_aist.DataFlowComponentBase.__init__ (self, mgr)
         self._port_spec = port_spec
         self._verb = verb
+        self._buffer_depth = buffer_depth
+        self._filters = filters
+        self._failed_filters = set()
+        self._out = BufferedOutput(sys.stdout, flush_interval)
+        self._dumper = dumpers[out_format](self._out, verb, port_spec,
+                projections)
 
     def onInitialize (self):
         try:
             self._num_ports = 0
             self._ports = []
+            self._port_names = []
+            self._buffer_full = []
 
             for new_port in self._port_spec:
                 if self._verb >= 3:
@@ -55,9 +418,11 @@ class FlexiDump (OpenRTM_aist.DataFlowComponentBase):
                     init_args = [None for ii in range(len(args) - 1)]
                 new_port_data = new_port[1](*init_args)
                 new_port_obj = OpenRTM_aist.InPort(port_name, new_port_data,
-                        OpenRTM_aist.RingBuffer(8))
+                        OpenRTM_aist.RingBuffer(self._buffer_depth))
                 self.registerInPort(port_name, new_port_obj)
                 self._ports.append([new_port_data, new_port_obj])
+                self._port_names.append(port_name)
+                self._buffer_full.append(0)
                 self._num_ports += 1
                 if self._verb >= 2:
                     print >>sys.stderr, 'Added port {0}'.format(new_port)
@@ -66,20 +431,50 @@ class FlexiDump (OpenRTM_aist.DataFlowComponentBase):
             return RTC.RTC_ERROR
         return RTC.RTC_OK
 
+    def onDeactivated(self, ec_id):
+        self._out.flush()
+        for name, count in zip(self._port_names, self._buffer_full):
+            if count:
+                print >>sys.stderr, 'Input port {0} buffer was found \
+full in {1} executions; samples may have been overwritten.'.format(name, count)
+        return RTC.RTC_OK
+
     def onExecute(self, ec_id):
         try:
-            for p in self._ports:
-                if p[1].isNew():
+            for ii, p in enumerate(self._ports):
+                # Read everything in the port's buffer, but no more, so that a
+                # port receiving data as fast as it is read cannot hold up the
+                # other ports
+                count = 0
+                while count < self._buffer_depth and p[1].isNew():
                     data = p[1].read()
-                    if self._verb == -1:
-                        print 'Input port {0} has new data'.format(p[0])
-                    else:
-                        print 'Input port {0} has new data: {1}'.format(p[0],
-                                data)
+                    count += 1
+                    if ii in self._filters and not self._matches(ii, data):
+                        continue
+                    self._dumper.dump(ii, self._port_names[ii], data)
+                if count == self._buffer_depth:
+                    # Samples may have been overwritten, but the port does not
+                    # say how many, so count the executions that found the
+                    # buffer full
+                    self._buffer_full[ii] += 1
+            self._dumper.check()
+            self._out.check()
         except:
             traceback.print_exc()
         return RTC.RTC_OK
 
+    def _matches(self, port_num, data):
+        # Checks a sample against its port's filter. Samples that the filter
+        # cannot be evaluated for do not match.
+        try:
+            return evaluate(self._filters[port_num], data)
+        except Exception, e:
+            if port_num not in self._failed_filters:
+                print >>sys.stderr, 'Error in filter of port {0}: {1}'.format(
+                        self._port_names[port_num], e)
+                self._failed_filters.add(port_num)
+            return False
+
 
 def find_port_type(type_name):
     types = [member for member in inspect.getmembers(RTC, inspect.isclass) \
@@ -95,15 +490,67 @@ def find_port_type(type_name):
     return types[0][1]
 
 
+def compile_port_exprs(exprs, ports):
+    '''Compiles a list of port:expression options into a dictionary of code
+    objects, keyed by port number. Ports are given by name or number.
+
+    '''
+    names = [p[2] or 'input' + str(ii) for ii, p in enumerate(ports)]
+    result = {}
+    for option in exprs:
+        port, sep, expr = option.partition(':')
+        if not sep or not expr.strip():
+            raise ValueError('Expected port:expression, got ' + option)
+        if port in names:
+            port_num = names.index(port)
+        elif port.isdigit() and int(port) < len(ports):
+            port_num = int(port)
+        else:
+            raise ValueError('No port named "{0}"'.format(port))
+        try:
+            result[port_num] = compile(expr.strip(), option, 'eval')
+        except SyntaxError, e:
+            raise ValueError('Invalid expression {0}: {1}'.format(option, e))
+    return result
+
+
 def get_options():
     try:
         usage = 'Usage: %prog [options]\nDump data streams to standard out.'
         parser = optparse.OptionParser(usage=usage)
+        parser.add_option('-d', '--buffer_depth', dest='buffer_depth',
+                type='int', default=8, help='Number of samples each port can \
+buffer between executions. All buffered samples are dumped each execution. \
+The number of executions that find a buffer full is printed on deactivation. \
+[Default: %default]')
+        parser.add_option('-e', '--select', dest='projections',
+                type='string', action='append', default=[],
+                help='Output only part of the samples of a port, given as \
+port:expression, where port is the port\'s name or number. The expression is \
+Python, evaluated with the sample\'s data as data, its time as tm and the \
+whole sample as sample, for example seq:data[0:10] or pose:data.position.x. \
+Can be given once per port.')
+        parser.add_option('--filter', dest='filters', type='string',
+                action='append', default=[],
+                help='Output only the samples of a port for which a \
+condition is true, given as port:expression, for example seq:data[3] > 0.5. \
+The expression is evaluated in the same way as for --select. Can be given \
+once per port.')
+        parser.add_option('-i', '--flush_interval', dest='flush_interval',
+                type='float', default=0.5, help='Longest time in seconds \
+that output is held before being written. [Default: %default]')
         parser.add_option('-n', '--port-names', dest='port_names',
                 type='string', default='',
                 help='Comma-separated list of port names. This list must be \
 the same length as the number of ports. If no list is provided, the ports \
 will be named automatically.')
+        parser.add_option('-o', '--output_format', dest='out_format',
+                type='choice', choices=dumpers.keys(),
+                default='text', help='Output format: text, JSON lines, CSV \
+(with sequences flattened to one column per element), length-prefixed \
+binary records, or stats, which prints a table of the rate, intervals and \
+latency of each port once per second instead of the data. \
+[Default: %default]')
         parser.add_option('-p', '--port', dest='ports', type='string',
                 action='append', default=[],
                 help='Port type. Multiple ports can be specified with \
@@ -118,6 +565,10 @@ output). [Default: %default]')
 
     if not options.ports:
         parser.error('Must specify at least one port')
+    if options.buffer_depth < 1:
+        parser.error('Buffer depth must be at least 1.')
+    if options.flush_interval < 0:
+        parser.error('Flush interval cannot be negative.')
     port_names = options.port_names.split(',')
 
     ports = []
@@ -132,8 +583,13 @@ output). [Default: %default]')
         port_info = (port_str, port_type, name)
         ports.append(port_info)
     options.ports = ports
+    try:
+        options.projections = compile_port_exprs(options.projections, ports)
+        options.filters = compile_port_exprs(options.filters, ports)
+    except ValueError, e:
+        parser.error(str(e))
 
-    if options.verbosity:
+    if options.verbosity and options.out_format == 'text':
         print 'Reading data from {0} ports'.format(len(ports))
 
     # Strip the options we use from sys.argv to avoid confusing the manager's
@@ -147,7 +603,9 @@ output). [Default: %default]')
 
 def comp_fact(opts):
     def fact_fun(mgr):
-        return FlexiDump(mgr, opts.ports, opts.verbosity)
+        return FlexiDump(mgr, opts.ports, opts.verbosity, opts.buffer_depth,
+                opts.out_format, opts.flush_interval, opts.projections,
+                opts.filters)
     return fact_fun
 
 
@@ -22,15 +22,23 @@ FlexiDupe component.
 __version__ = '$Revision: $'
 # $Source$
 
-import inspect, pickle, re, sys
+import collections, inspect, os, pickle, re, sys, threading
 from traceback import print_exception
 from optparse import OptionParser, OptionError
 
 import OpenRTM_aist, RTC
 
+# The modules shared between components are kept in the common directory
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), os.pardir, 'common'))
+import flexitime
+
 # Globals set by command line options
 ports = []
 verbosity = 0
+bufferDepth = 8
+numThreads = 0
+queueSize = 8
+queuePolicy = 'drop_oldest'
 
 flexidump_spec = ['implementation_id',        'FlexiDupe',
                 'type_name',                'FlexiDupe',
@@ -44,6 +52,122 @@ flexidump_spec = ['implementation_id',        'FlexiDupe',
                 'lang_type',                'SCRIPT',
                 '']
 
+class OutputQueue (object):
+    '''The samples waiting to be written to one output port, and counters of the samples written and dropped and of
+    the time they spent waiting.'''
+    def __init__ (self, name, port):
+        self.name = name
+        self.port = port
+        self.queue = collections.deque ()
+        # True while the output is waiting for a thread or being written by one
+        self.scheduled = False
+        # True while a thread is in the output's write ()
+        self.writing = False
+        self.written = 0
+        self.dropped = 0
+        # Samples still queued or being written when the pool was closed
+        self.undelivered = 0
+        self.totalLatency = 0
+        self.maxLatency = 0
+
+
+class WriterPool (object):
+    '''Writes samples to output ports from a pool of threads, so that a slow or blocked consumer does not hold up the
+    other outputs or the execution context. Each output has its own bounded queue, and is written by at most one
+    thread at a time, so each output receives its samples in order. When an output's queue is full, put() either
+    blocks until there is space, drops the oldest queued sample, or drops the new sample, depending on the policy.'''
+    def __init__ (self, outputs, numThreads, queueSize=8, policy='drop_oldest'):
+        self.__outputs = outputs
+        self.__queueSize = queueSize
+        self.__policy = policy
+        # Outputs with samples waiting, in the order they will be served
+        self.__ready = collections.deque ()
+        self.__cond = threading.Condition ()
+        self.__closing = False
+        self.__threads = []
+        for ii in range (numThreads):
+            thread = threading.Thread (target = self.__run, name = 'FlexiDupe writer %d' % ii)
+            thread.daemon = True
+            thread.start ()
+            self.__threads.append (thread)
+
+
+    def put (self, output, data):
+        with self.__cond:
+            if self.__closing:
+                output.dropped += 1
+                return
+            if len (output.queue) >= self.__queueSize:
+                if self.__policy == 'drop_newest':
+                    output.dropped += 1
+                    return
+                elif self.__policy == 'drop_oldest':
+                    output.queue.popleft ()
+                    output.dropped += 1
+                else:
+                    while len (output.queue) >= self.__queueSize and not self.__closing:
+                        self.__cond.wait ()
+                    if self.__closing:
+                        output.dropped += 1
+                        return
+            output.queue.append ((flexitime.monotonic_ns (), data))
+            if not output.scheduled:
+                output.scheduled = True
+                self.__ready.append (output)
+                self.__cond.notify_all ()
+
+
+    def close (self, timeout=1.0):
+        '''Writes the samples still queued, then stops the threads. Threads still writing after timeout seconds (to a
+        blocked consumer, for example) are left behind, and the samples they did not write are counted as undelivered.
+        Returns the outputs that were still being written.'''
+        with self.__cond:
+            self.__closing = True
+            self.__cond.notify_all ()
+        deadline = flexitime.monotonic_ns () + flexitime.float_to_ns (timeout)
+        for thread in self.__threads:
+            thread.join (max (deadline - flexitime.monotonic_ns (), 0) / 1e9)
+        with self.__cond:
+            stuck = []
+            for output in self.__outputs:
+                output.undelivered += len (output.queue)
+                output.queue.clear ()
+                if output.writing:
+                    output.undelivered += 1
+                    stuck.append (output)
+            self.__ready.clear ()
+        return stuck
+
+
+    def __run (self):
+        while True:
+            with self.__cond:
+                while not self.__ready and not self.__closing:
+                    self.__cond.wait ()
+                if not self.__ready:
+                    return
+                output = self.__ready.popleft ()
+                queuedTime, data = output.queue.popleft ()
+                output.writing = True
+                # Wake any put() blocked on a full queue
+                self.__cond.notify_all ()
+            try:
+                output.port.write (data)
+            except:
+                print_exception (*sys.exc_info ())
+            latency = flexitime.monotonic_ns () - queuedTime
+            with self.__cond:
+                output.writing = False
+                output.written += 1
+                output.totalLatency += latency
+                output.maxLatency = max (output.maxLatency, latency)
+                if output.queue:
+                    self.__ready.append (output)
+                    self.__cond.notify_all ()
+                else:
+                    output.scheduled = False
+
+
 class FlexiDupe (OpenRTM_aist.DataFlowComponentBase):
     def __init__ (self, manager):
         OpenRTM_aist.DataFlowComponentBase.__init__ (self, manager)
@@ -55,10 +179,13 @@ class FlexiDupe (OpenRTM_aist.DataFlowComponentBase):
             self.__numPorts = 0
             self.__inPorts = []
             self.__outPorts = []
+            self.__bufferFull = []
+            self.__outQueues = []
+            self.__pool = None
 
             for newPort in ports:
                 newPortData = newPort[1] (RTC.Time (0, 0), [])
-                newPortPort = OpenRTM_aist.InPort ('input%d' % self.__numPorts, newPortData, OpenRTM_aist.RingBuffer (8))
+                newPortPort = OpenRTM_aist.InPort ('input%d' % self.__numPorts, newPortData, OpenRTM_aist.RingBuffer (bufferDepth))
                 self.registerInPort ('input%d' % self.__numPorts, newPortPort)
                 self.__inPorts.append ((newPortData, newPortPort))
 
@@ -69,6 +196,7 @@ class FlexiDupe (OpenRTM_aist.DataFlowComponentBase):
                     self.registerOutPort ('output%d_%d' % (self.__numPorts, ii), newOutPort)
                     newOutPorts.append ((newOutPortData, newOutPort))
                 self.__outPorts.append (newOutPorts)
+                self.__bufferFull.append (0)
 
                 self.__numPorts += 1
         except:
@@ -77,16 +205,63 @@ class FlexiDupe (OpenRTM_aist.DataFlowComponentBase):
         return RTC.RTC_OK
 
 
+    def onActivated (self, ec_id):
+        if numThreads > 0:
+            # New queues are made for each activation, as a thread left writing to a blocked consumer by the last
+            # pool may still hold the old ones
+            self.__outQueues = [[OutputQueue ('output%d_%d' % (ii, jj), outPort[1]) \
+                                 for jj, outPort in enumerate (outPorts)] \
+                                for ii, outPorts in enumerate (self.__outPorts)]
+            self.__pool = WriterPool (sum (self.__outQueues, []), numThreads, queueSize, queuePolicy)
+        return RTC.RTC_OK
+
+
+    def onDeactivated (self, ec_id):
+        if self.__pool is not None:
+            stuck = self.__pool.close ()
+            self.__pool = None
+            for output in stuck:
+                print 'Output %s is still being written; gave up waiting for it.' % output.name
+            for output in sum (self.__outQueues, []):
+                if output.undelivered:
+                    print 'Output %s: %d samples were not delivered.' % (output.name, output.undelivered)
+            if verbosity >= 1:
+                for output in sum (self.__outQueues, []):
+                    if output.written:
+                        meanLatency = output.totalLatency / output.written
+                    else:
+                        meanLatency = 0
+                    print '%s: wrote %d samples, dropped %d, latency mean %.3f ms, max %.3f ms' % \
+                            (output.name, output.written, output.dropped, meanLatency / 1e6,
+                             output.maxLatency / 1e6)
+        for ii, count in enumerate (self.__bufferFull):
+            if count:
+                print 'Input port input%d buffer was found full in %d executions; samples may have been overwritten.' % \
+                        (ii, count)
+        return RTC.RTC_OK
+
+
     def onExecute (self, ec_id):
         try:
             for ii in range (self.__numPorts):
-                if self.__inPorts[ii][1].isNew ():
+                # Read everything in the port's buffer, but no more, so that a fast writer cannot hold up
+                # the other ports
+                count = 0
+                while count < bufferDepth and self.__inPorts[ii][1].isNew ():
                     data = self.__inPorts[ii][1].read ()
-                    for outPort in self.__outPorts[ii]:
-                        outPort[0].data = data.data
-                        outPort[0].tm.sec = data.tm.sec
-                        outPort[0].tm.nsec = data.tm.nsec
-                        outPort[1].write ()
+                    count += 1
+                    # The received data object is written to every output, so the data is shared rather than
+                    # copied into each output's own data object
+                    if self.__pool is not None:
+                        for output in self.__outQueues[ii]:
+                            self.__pool.put (output, data)
+                    else:
+                        for outPort in self.__outPorts[ii]:
+                            outPort[1].write (data)
+                # Samples may have been overwritten, but the port does not say how many, so count the executions
+                # that found the buffer full
+                if count == bufferDepth:
+                    self.__bufferFull[ii] += 1
         except:
             print_exception (*sys.exc_info ())
         return RTC.RTC_OK
@@ -110,15 +285,29 @@ def FindPortType (typeName):
 
 
 def GetPortOptions ():
-    global ports, verbosity
+    global ports, verbosity, bufferDepth, numThreads, queueSize, queuePolicy
 
     try:
         usage = 'usage: %prog [options]\nDuplicate a single data stream into \
 many data streams.'
         parser = OptionParser (usage = usage)
+        parser.add_option ('-d', '--buffer_depth', dest = 'bufferDepth', type = 'int', default = 8,
+                            help = 'Number of samples each input port can buffer between executions. All '\
+                            'buffered samples are duplicated each execution. The number of executions that find a buffer full is '\
+                            'printed on deactivation. [Default: %default]')
         parser.add_option ('-p', '--port', dest = 'ports', type = 'string', action = 'append', default = [],
                             help = 'Port type and number of times to duplicate. Multiple ports can '\
                             'be specified with multiple occurrences of this option. e.g. "TimedFloatSeq:4"')
+        parser.add_option ('-q', '--queue_size', dest = 'queueSize', type = 'int', default = 8,
+                            help = 'Number of samples each output can queue when writing from threads. '\
+                            '[Default: %default]')
+        parser.add_option ('--queue_policy', dest = 'queuePolicy', type = 'choice',
+                            choices = ['block', 'drop_oldest', 'drop_newest'], default = 'drop_oldest',
+                            help = 'What to do when an output\'s queue is full: block until there is space, '\
+                            'drop the oldest queued sample, or drop the new sample. [Default: %default]')
+        parser.add_option ('-t', '--threads', dest = 'numThreads', type = 'int', default = 0,
+                            help = 'Number of threads to write the outputs from. With 0, outputs are written '\
+                            'one after another by the execution context. [Default: %default]')
         parser.add_option ('-v', '--verbosity', dest = 'verbosity', type = 'int', default = 0,
                             help = 'Verbosity level (higher numbers give more output). [Default: %default]')
         parser.add_option ('-f', dest = 'configfile', type = 'string', default = '',
@@ -131,7 +320,20 @@ many data streams.'
     if len (options.ports) == 0:
         parser.error ('Must specify at least one port')
 
+    if options.bufferDepth < 1:
+        parser.error ('Buffer depth must be at least 1')
+
+    if options.numThreads < 0:
+        parser.error ('Number of threads cannot be negative')
+
+    if options.queueSize < 1:
+        parser.error ('Queue size must be at least 1')
+
     verbosity = options.verbosity
+    bufferDepth = options.bufferDepth
+    numThreads = options.numThreads
+    queueSize = options.queueSize
+    queuePolicy = options.queuePolicy
 
     for portStr in options.ports:
         fields = portStr.split (':')
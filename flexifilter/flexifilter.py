@@ -22,34 +22,72 @@ FlexiFilter component.
 __version__ = '$Revision: $'
 # $Source$
 
-import inspect, re, sys
+import inspect, os, re, sys
+from itertools import izip
+from operator import itemgetter
 from traceback import print_exception
 from optparse import OptionParser, OptionError
 
 import OpenRTM_aist, RTC
 
-from typemap import typeMap, multMap
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+from typemap import typeMap, multMap, dtypeMap
+
+# The modules shared between components are kept in the common directory
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), os.pardir, 'common'))
+import flexitime
 
 #Globals set by command line options
 inputPorts = []
 outputPorts = []
 newestTime = False
+vectorise = False
 verbosity = 0
 zeroOld = False
 
 
-def CompTimes (t1, t2):
-	if t1.sec < t2.sec:
-		return -1
-	elif t1.sec > t2.sec:
-		return 1
-	elif t1.sec == t2.sec:
-		if t1.nsec < t2.nsec:
-			return -1
-		elif t1.nsec > t2.nsec:
-			return 1
+# Class to track the time of the data on each pin of a sequence port, along with the oldest and newest of those times
+class PinTimes:
+	def __init__ (self, length):
+		self.times = [0 for ii in range (length)]	# Time in nanoseconds of the data on each pin
+		self.counts = {0: length}		# Number of pins holding each distinct time
+		self.oldest = 0
+		self.newest = 0
+
+
+	def Set (self, pins, newTime):
+		# Sets the time of the given pins. The number of distinct times is bounded by the number of sources for the
+		# port, so finding a new oldest or newest time when one is removed is cheap.
+		times = self.times
+		counts = self.counts
+		changed = 0
+		removedLimit = False
+		for pin in pins:
+			oldTime = times[pin]
+			if oldTime == newTime:
+				continue
+			times[pin] = newTime
+			changed += 1
+			counts[oldTime] -= 1
+			if counts[oldTime] == 0:
+				del counts[oldTime]
+				if oldTime == self.oldest or oldTime == self.newest:
+					removedLimit = True
+		if changed == 0:
+			return
+		counts[newTime] = counts.get (newTime, 0) + changed
+		if removedLimit:
+			self.oldest = min (counts)
+			self.newest = max (counts)
 		else:
-			return 0
+			if newTime < self.oldest:
+				self.oldest = newTime
+			if newTime > self.newest:
+				self.newest = newTime
 
 
 # Class to store a pin mapping
@@ -85,6 +123,185 @@ class PinMapping:
 			return outputData
 
 
+	def Compile (self):
+		# Returns a function performing the same conversion as ConvertData with the branching resolved, or None if
+		# the data passes through unchanged
+		multiplier = self.multiplier
+		convFunc = self.convFunc
+		if convFunc is None:
+			if multiplier is None:
+				return None
+			return lambda data: data * multiplier
+		if multiplier is None:
+			return convFunc
+		if self.postMult:
+			return lambda data: convFunc (data) * multiplier
+		return lambda data: convFunc (data * multiplier)
+
+
+# Identity conversion used for pins without a multiplier or conversion in a block that needs converting
+def NoConversion (data):
+	return data
+
+
+# Class to store all the pins of one output port that are sourced from the same input port
+class PlanBlock:
+	def __init__ (self, inPort, outPort):
+		self.inPort = inPort			# Source Port object
+		self.outPort = outPort			# Destination Port object
+		self.inPins = []				# Source pin for each entry
+		self.outPins = []				# Destination pin for each entry
+		self.mappings = []				# PinMapping for each entry
+		self.gather = None				# Function to pull the source values from the input data (set by Compile)
+		self.convert = None				# Function to convert the gathered values, or None (set by Compile)
+		self.scatter = None				# Function to place the converted values in the output (set by Compile)
+		self.vector = False				# True if Apply needs the input data as a NumPy array
+
+
+	def AddEntry (self, inPin, outPin, mapping):
+		self.inPins.append (inPin)
+		self.outPins.append (outPin)
+		self.mappings.append (mapping)
+
+
+	def Compile (self):
+		numPins = len (self.inPins)
+
+		# Gather
+		if self.inPort.length == 0:
+			self.gather = lambda data: (data,) * numPins
+		elif numPins == 1:
+			inPin = self.inPins[0]
+			self.gather = lambda data: (data[inPin],)
+		elif IsContiguous (self.inPins):
+			inStart = self.inPins[0]
+			inStop = self.inPins[-1] + 1
+			self.gather = lambda data: data[inStart:inStop]
+		else:
+			self.gather = itemgetter (*self.inPins)
+
+		# Convert
+		convFuncs = [mapping.Compile () for mapping in self.mappings]
+		if convFuncs.count (None) == numPins:
+			self.convert = None
+		elif convFuncs.count (convFuncs[0]) == numPins:
+			# Every pin uses the same conversion function (i.e. no multipliers), so it can be mapped directly
+			convFunc = convFuncs[0]
+			self.convert = lambda values: map (convFunc, values)
+		else:
+			convFuncs = [NoConversion if convFunc is None else convFunc for convFunc in convFuncs]
+			self.convert = lambda values: [convFunc (value) for convFunc, value in izip (convFuncs, values)]
+
+		# Scatter
+		outPort = self.outPort
+		if outPort.length == 0:
+			def ScatterScalar (values):
+				outPort.data.data = values[0]
+			self.scatter = ScatterScalar
+		elif IsContiguous (self.outPins):
+			outStart = self.outPins[0]
+			outStop = self.outPins[-1] + 1
+			def ScatterSlice (values):
+				outPort.data.data[outStart:outStop] = values
+			self.scatter = ScatterSlice
+		else:
+			outPins = self.outPins
+			def ScatterPins (values):
+				outData = outPort.data.data
+				for outPin, value in izip (outPins, values):
+					outData[outPin] = value
+			self.scatter = ScatterPins
+
+
+	def Apply (self, data, dataTime, inArray = None):
+		# Gather the source values, convert them, and place them in the output port
+		values = self.gather (data.data)
+		if self.convert is not None:
+			values = self.convert (values)
+		self.scatter (values)
+		# Update the output port's time
+		outPort = self.outPort
+		if outPort.length == 0:
+			outPort.data.tm = data.tm
+		else:
+			outPort.times.Set (self.outPins, dataTime)
+
+
+# Class to store a block between two numeric sequence ports, converted using NumPy array operations
+class VectorPlanBlock (PlanBlock):
+	def Compile (self):
+		PlanBlock.Compile (self)
+		self.vector = True
+		self.inDtype = numpy.dtype (dtypeMap[self.inPort.type.__name__])
+		self.outDtype = numpy.dtype (dtypeMap[self.outPort.type.__name__])
+
+		if IsContiguous (self.inPins):
+			self.inIndex = slice (self.inPins[0], self.inPins[-1] + 1)
+		else:
+			self.inIndex = numpy.array (self.inPins, dtype = numpy.intp)
+
+		# All pins in a block share the same conversion and multiplication order, as these depend only on the port types
+		if [mapping.multiplier for mapping in self.mappings].count (None) == len (self.mappings):
+			self.multipliers = None
+		else:
+			self.multipliers = numpy.array ([1.0 if mapping.multiplier is None else mapping.multiplier
+				for mapping in self.mappings], dtype = numpy.float64)
+		self.postMult = self.mappings[0].postMult
+		self.cast = self.mappings[0].convFunc is not None or self.multipliers is not None
+
+
+	def ToArray (self, data):
+		return numpy.asarray (data.data, dtype = self.inDtype)
+
+
+	def Apply (self, data, dataTime, inArray = None):
+		# Gather the block, scale it and cast it to the output type in one pass. inArray is the input data already
+		# converted by ToArray, shared by all the blocks reading from the same input port.
+		if inArray is None:
+			inArray = self.ToArray (data)
+		values = inArray[self.inIndex]
+		if self.multipliers is not None and not self.postMult:
+			values = values * self.multipliers
+		if self.cast:
+			values = values.astype (self.outDtype)
+		if self.multipliers is not None and self.postMult:
+			values = values * self.multipliers
+		self.scatter (values.tolist ())
+		# Update the output port's pin times
+		self.outPort.times.Set (self.outPins, dataTime)
+
+
+def IsContiguous (pins):
+	return pins == range (pins[0], pins[0] + len (pins))
+
+
+def CompilePlan (inputPorts, outputPorts):
+	# Builds, for each input port, the list of PlanBlocks that must be executed when that port has new data
+	blocks = {}
+	for outPort in outputPorts:
+		if outPort.length == 0:
+			pinMaps = [(0, outPort.sourceMap)]
+		else:
+			pinMaps = enumerate (outPort.sourceMap)
+		for outPin, pinMap in pinMaps:
+			if pinMap is None:
+				continue
+			key = (pinMap.port, outPort.index)
+			if key not in blocks:
+				inPort = inputPorts[pinMap.port]
+				if vectorise and inPort.type.__name__ in dtypeMap and outPort.type.__name__ in dtypeMap:
+					blocks[key] = VectorPlanBlock (inPort, outPort)
+				else:
+					blocks[key] = PlanBlock (inPort, outPort)
+			blocks[key].AddEntry (pinMap.pin, outPin, pinMap)
+
+	plan = [[] for port in inputPorts]
+	for key in sorted (blocks.keys ()):
+		blocks[key].Compile ()
+		plan[key[0]].append (blocks[key])
+	return plan
+
+
 # Structure to store a port
 class Port:
 	def __init__ (self, desc, index, type, length, emptyVal):
@@ -108,18 +325,16 @@ class Port:
 		if self.length == 0:
 			self.times = None		# No need to store a history of received times for a scalar
 		else:
-			self.times = [RTC.Time (0, 0) for ii in range (self.length)]
+			self.times = PinTimes (self.length)
 
 
 	def GetDataTime (self):
 		if self.length == 0:
 			return self.data.tm
-		times = self.times
-		times.sort (cmp = CompTimes)
 		if newestTime:
-			return times[-1]
+			return flexitime.ns_to_time (self.times.newest, self.data.tm)
 		else:
-			return times[0]
+			return flexitime.ns_to_time (self.times.oldest, self.data.tm)
 
 
 flexifilter_spec = ['implementation_id',	'FlexiFilter',
@@ -161,6 +376,9 @@ class FlexiFilter (OpenRTM_aist.DataFlowComponentBase):
 				self.registerOutPort ('output%d' % newPort.index, newPortPort)
 				newPort.data = newPortData
 				newPort.portObj = newPortPort
+
+			# Compile the pin mappings into the blocks to execute for each input port
+			self.__plan = CompilePlan (self.__inputPorts, self.__outputPorts)
 		except:
 			print_exception (*sys.exc_info ())
 			return RTC.RTC_ERROR
@@ -180,60 +398,38 @@ class FlexiFilter (OpenRTM_aist.DataFlowComponentBase):
 	def onExecute (self, ec_id):
 		try:
 			haveNewData = False
-			inputData = []
-
 			outputPortIsNew = [False for ii in range (self.__numOutputPorts)]
+
+			# Run the blocks sourced from each input port that has new data
 			for port in self.__inputPorts:
-				if port.portObj.isNew ():
-					inputData.append (port.portObj.read ())
+				if not port.portObj.isNew ():
+					continue
+				data = port.portObj.read ()
+				dataTime = flexitime.time_to_ns (data.tm)
+				if verbosity >= 2:
+					print 'Input port %d has new data: ' % port.index + str (data.data)
+				if not haveNewData:
 					haveNewData = True
-					if verbosity >= 2:
-						print 'Input port %d has new data: ' % port.index + str (inputData[-1].data)
-				else:
-					inputData.append (None)		# No data for this port
-			if not haveNewData:
-				return RTC.RTC_OK
-
-			# For each pin on each output port, check if its input has new data and convert as appropriate
-			for port in self.__outputPorts:
-				if zeroOld:
-					# Clear out old data (this will only be written if there is new data for this port available)
-					if port.length != 0:
-						port.data.data = [port.emptyVal for kk in range (port.length)]
-					else:
-						port.data.data = port.emptyVal
-				if port.length == 0:		# Scalar port
-					if port.sourceMap is None:
-						continue		# No input for this pin
-					if inputData[port.sourceMap.port] is None:
-						continue		# No new data for this pin
-					if self.__inputPorts[port.sourceMap.port].length == 0:
-						newData = inputData[port.sourceMap.port].data
-					else:
-						newData = inputData[port.sourceMap.port].data[port.sourceMap.pin]
-					# Copy the (possibly converted) data to the output port and mark the port as new
-					port.data.data = port.sourceMap.ConvertData (newData)
-					port.data.tm = inputData[port.sourceMap.port].tm
-					outputPortIsNew[port.index] = True
-				else:
-					for ii in range (port.length):
-						if port.sourceMap[ii] is None:
-							continue	# No input for this pin
-						sourceMap = port.sourceMap[ii]
-						if inputData[sourceMap.port] is None:
-							continue	# No new data for this pin
-						if self.__inputPorts[sourceMap.port].length == 0:
-							newData = inputData[sourceMap.port].data
-						else:
-							newData = inputData[sourceMap.port].data[sourceMap.pin]
-						# Copy the (possibly converted) data to the output port and mark the port as new
-						port.data.data[ii] = sourceMap.ConvertData (newData)
-						port.times[ii] = inputData[sourceMap.port].tm
-						port.data.tm = port.GetDataTime ()
-						outputPortIsNew[port.index] = True
-			# Write each output port that has new data
+					if zeroOld:
+						# Clear out old data (this will only be written if there is new data for this port available)
+						for outPort in self.__outputPorts:
+							if outPort.length != 0:
+								outPort.data.data = [outPort.emptyVal for kk in range (outPort.length)]
+							else:
+								outPort.data.data = outPort.emptyVal
+				# The input is converted to an array at most once, for all the vectorised blocks that read from it
+				inArray = None
+				for block in self.__plan[port.index]:
+					if block.vector and inArray is None:
+						inArray = block.ToArray (data)
+					block.Apply (data, dataTime, inArray)
+					outputPortIsNew[block.outPort.index] = True
+
+			# Set the time of, and write, each output port that has new data
 			for ii in range (self.__numOutputPorts):
 				if outputPortIsNew[ii]:
+					if self.__outputPorts[ii].length != 0:
+						self.__outputPorts[ii].data.tm = self.__outputPorts[ii].GetDataTime ()
 					if verbosity >= 2:
 						print 'Output port %d has new data: ' % ii + str (self.__outputPorts[ii].data.data)
 					self.__outputPorts[ii].portObj.write ()
@@ -350,7 +546,7 @@ def DecodePortStr (portStr):
 
 
 def GetPortOptions ():
-	global inputPorts, outputPorts, newestTime, verbosity, zeroOld
+	global inputPorts, outputPorts, newestTime, vectorise, verbosity, zeroOld
 
 	try:
 		usage = 'usage: %prog [options]\nMap input ports to output ports, with multipliers and type conversion.'
@@ -371,6 +567,9 @@ def GetPortOptions ():
 							help = 'Output port specification in the format "type[:length]". Length is necessary for sequence ports.')
 		parser.add_option ('-v', '--verbosity', dest = 'verbosity', type = 'int', default = 0,
 							help = 'Verbosity level (higher numbers give more output). [Default: %default]')
+		parser.add_option ('-x', '--vectorise', dest = 'vectorise', action = 'store_true', default = False,
+							help = 'Convert mappings between numeric sequence ports using NumPy array operations. Requires '\
+							'NumPy. [Default: %default]')
 		parser.add_option ('-z', '--zeroold', dest = 'zeroOld', action = 'store_true', default = False,
 							help = 'If new data is not available on one of the source ports for an output, pins connected to that port '\
 							'are set to zero (or equivalent) when other pins are updated. Otherwise, they remain at their previous '\
@@ -382,6 +581,10 @@ def GetPortOptions ():
 
 	newestTime = options.newestTime
 	zeroOld = options.zeroOld
+	vectorise = options.vectorise
+
+	if vectorise and numpy is None:
+		parser.error ('Vectorised mode requires NumPy.')
 
 	if len (options.inputport) == 0:
 		parser.error ('Must specify at least one input port.')
@@ -453,8 +656,12 @@ def GetPortOptions ():
 
 		# Get conversion function for this output pin
 		if inputPorts[inPort].type == outputPorts[outPort].type:
-			# Same type, no conversion necessary
-			convFunc = None
+			# Same type, no conversion necessary, except that multiplied integers must be made integers again (in the
+			# same way as when converting to an integer type, so that the vectorised mode gives the same result)
+			if mult is not None and typeMap[outputPorts[outPort].type.__name__][0] is int:
+				convFunc = int
+			else:
+				convFunc = None
 			postMultiply = False
 		else:
 			convFunc, postMultiply = GetConversionFunction (inputPorts[inPort].type.__name__, outputPorts[outPort].type.__name__)
@@ -168,3 +168,14 @@ multMap = {
 						'TimedFloatSeq': True, 'TimedDoubleSeq': True, 'TimedCharSeq': -1,
 						'TimedBooleanSeq': -1, 'TimedOctetSeq': -1, 'TimedStringSeq': -1}
 }
+
+
+# NumPy data types for the sequence port types that can be converted in vectorised mode
+dtypeMap = {
+	'TimedShortSeq':	'int16',
+	'TimedLongSeq':		'int32',
+	'TimedUShortSeq':	'uint16',
+	'TimedULongSeq':	'uint32',
+	'TimedFloatSeq':	'float32',
+	'TimedDoubleSeq':	'float64',
+}
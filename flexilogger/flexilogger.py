@@ -17,11 +17,14 @@ FlexiLogger component.
 
 '''
 
+import collections
 import cPickle as pickle
 import inspect
 import optparse
+import os
 import re
 import sys
+import threading
 import time
 from traceback import print_exc
 
@@ -29,57 +32,11 @@ import UI, UI__POA
 import OpenRTM_aist
 import RTC
 
-
-def time_to_float(timeVal):
-    return timeVal.sec + timeVal.nsec / 1e9
-
-
-def float_to_time(floatVal):
-    result = RTC.Time(0, 0)
-    result.sec = int(floatVal)
-    result.nsec = int((floatVal - result.sec) * 1e9)
-    return result
-
-
-def compare_times(t1, t2):
-    if t1.sec < t2.sec:
-        return -1
-    elif t1.sec > t2.sec:
-        return 1
-    elif t1.sec == t2.sec:
-        if t1.nsec < t2.nsec:
-            return -1
-        elif t1.nsec > t2.nsec:
-            return 1
-        else:
-            return 0
-
-
-def add_times(t1, t2):
-    result = RTC.Time(0, 0)
-    result.sec = t1.sec + t2.sec
-    result.nsec = t1.nsec + t2.nsec
-    # Need to account for overflow in nanoseconds
-    if result.nsec >= 1e9:
-        # Should never get enough nanoseconds to make 2 seconds
-        result.sec += 1
-        result.nsec = int(result.nsec - 1e9)
-    return result
-
-
-def subtract_times(t1, t2):
-    result = RTC.Time(0, 0)
-    # Seconds is easy
-    result.sec = t1.sec - t2.sec
-    result.nsec = t1.nsec - t2.nsec
-    # Need to account for overflow in nanoseconds
-    if result.nsec < 0:
-        # Difference in nsec can never be greater than a single second
-        result.sec -= 1
-        # Take the inverse number of nanoseconds, remembering that nsec is
-        # negative
-        result.nsec = int(1e9 + result.nsec)
-    return result
+# The modules shared between components are kept in the common directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir, 'common'))
+import flexitime
+import logformat
 
 
 class BasicOperationsImpl(UI__POA.BasicOperations):
@@ -96,10 +53,318 @@ class BasicOperationsImpl(UI__POA.BasicOperations):
         return True
 
 
+class AsyncLogWriter(threading.Thread):
+    '''Writes log items from a bounded queue in a separate thread, so that a
+    slow disk does not stall the execution context. When the queue is full,
+    write() either blocks until there is space, drops the oldest queued item,
+    or drops the new item, depending on the policy.
+
+    '''
+    def __init__(self, writer, queue_size=1024, policy='block',
+            batch_size=64):
+        threading.Thread.__init__(self, name='FlexiLogger writer')
+        self.daemon = True
+        self._writer = writer
+        self._queue = collections.deque()
+        self._queue_size = queue_size
+        self._policy = policy
+        self._batch_size = batch_size
+        self._cond = threading.Condition()
+        self._closing = False
+        self._error = None
+        self.queued = 0
+        self.dropped = 0
+        self.written = 0
+        self.lost = 0
+        self.max_depth = 0
+        self.start()
+
+    def write_header(self, port_spec):
+        self._writer.write_header(port_spec)
+
+    def write(self, port_num, port_type, data_time, data):
+        with self._cond:
+            if self._error:
+                raise self._error
+            if len(self._queue) >= self._queue_size:
+                if self._policy == 'drop_newest':
+                    self.dropped += 1
+                    return
+                elif self._policy == 'drop_oldest':
+                    self._queue.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self._queue) >= self._queue_size and \
+                            not self._error:
+                        self._cond.wait()
+                    if self._error:
+                        raise self._error
+            self._queue.append((port_num, port_type, data_time, data))
+            self.queued += 1
+            self.max_depth = max(self.max_depth, len(self._queue))
+            self._cond.notify_all()
+
+    def depth(self):
+        with self._cond:
+            return len(self._queue)
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closing:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                batch = [self._queue.popleft() for ii in \
+                        range(min(self._batch_size, len(self._queue)))]
+                # Wake any writer blocked on a full queue
+                self._cond.notify_all()
+            count = 0
+            try:
+                for item in batch:
+                    self._writer.write(*item)
+                    count += 1
+            except Exception, e:
+                print >>sys.stderr, 'Error writing to log file: {0}'.format(e)
+                if not isinstance(e, (IOError, pickle.PicklingError)):
+                    # Report any other error to write() the same way, so that
+                    # the execution context stops logging
+                    e = IOError('Error in log writer thread: {0}'.format(e))
+                with self._cond:
+                    self._error = e
+                    self.written += count
+                    self.lost += len(batch) - count + len(self._queue)
+                    self._queue.clear()
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                self.written += count
+
+    def close(self):
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self.join()
+        self._writer.close()
+
+
+class PreTriggerBuffer(object):
+    '''Holds the samples received in the last window nanoseconds, for writing
+    out when a trigger arrives. Samples are collected in typed columns, as in a
+    binary log, and each block of samples is encoded into a compact string
+    once it is full or covers a quarter of the window. Blocks are discarded as
+    they fall out of the window.
+
+    '''
+    def __init__(self, port_spec, window,
+            block_size=logformat.DEFAULT_BLOCK_SIZE):
+        self._port_spec = port_spec
+        self._window = window
+        self._block_size = block_size
+        self._columns = [logformat.Column(ii, p[0]) \
+                for ii, p in enumerate(port_spec)]
+        # Encoded blocks, as (newest time, [encoded chunks]) pairs
+        self._blocks = collections.deque()
+        self._count = 0
+        self._first_time = None
+        self._newest = None
+
+    def append(self, port_num, data_time, data):
+        if self._first_time is None:
+            self._first_time = data_time
+        if self._newest is None or data_time > self._newest:
+            self._newest = data_time
+        self._columns[port_num].append(data_time, data)
+        self._count += 1
+        if self._count >= self._block_size or \
+                self._newest - self._first_time >= self._window // 4:
+            self._seal_block()
+        while self._blocks and \
+                self._blocks[0][0] < self._newest - self._window:
+            self._blocks.popleft()
+
+    def flush(self):
+        '''Generates the samples in the window as (port number, port type
+        string, data time, data) items in time order, and empties the buffer.
+
+        '''
+        self._seal_block()
+        if self._newest is None:
+            return
+        oldest = self._newest - self._window
+        self._newest = None
+        while self._blocks:
+            newest, encoded = self._blocks.popleft()
+            chunks = []
+            for c in encoded:
+                chunk, end = logformat.decode_chunk(c, 0, False)
+                chunks.append(chunk)
+            for item in logformat.make_items(chunks, self._port_spec):
+                if item[2] >= oldest:
+                    yield item
+
+    def _seal_block(self):
+        if not self._count:
+            return
+        newest = max([max(c.times) for c in self._columns if c.times])
+        self._blocks.append((newest,
+            [c.encode() for c in self._columns if c.times]))
+        for c in self._columns:
+            c.clear()
+        self._count = 0
+        self._first_time = None
+
+
+class PlaybackScheduler(threading.Thread):
+    '''Sends log items to the output ports at their due times from a separate
+    thread, sleeping between items rather than polling from the execution
+    context. Due times are measured on the monotonic clock from a fixed start
+    point, so sleep overruns are corrected on the next item instead of
+    accumulating. If period is given, the times in the log are ignored and
+    items are sent at that fixed period (in nanoseconds). The gaps between
+    items are divided by speed; a speed of 0 sends items as fast as possible.
+
+    '''
+    # Longest single sleep, so that pausing and stopping take effect promptly
+    max_sleep = 0.05
+
+    def __init__(self, first_item, read_item, write_item, period=None,
+            speed=1.0, paused=False):
+        threading.Thread.__init__(self, name='FlexiLogger playback')
+        self.daemon = True
+        self._item = first_item
+        self._read_item = read_item
+        self._write_item = write_item
+        self._period = period
+        self._speed = speed
+        self._cond = threading.Condition()
+        self._paused = paused
+        self._steps = 0
+        self._stopping = False
+        self._first_time = first_item[2]
+        self._start_time = flexitime.monotonic_ns()
+        self._wall_start = flexitime.now_ns()
+        # Offset from log times to current times at the start of playback
+        self.offset = self._wall_start - self._first_time
+        # Set when playback ends because the log is finished or broken
+        self.finished = False
+        self.sent = 0
+        self.max_late = 0
+        self._late_sum = 0
+        self._late_sq_sum = 0
+
+    def pause(self):
+        with self._cond:
+            self._paused = True
+
+    def resume(self):
+        with self._cond:
+            self._paused = False
+            self._cond.notify_all()
+
+    def step(self):
+        '''Pauses playback after sending the next item.'''
+        with self._cond:
+            self._paused = True
+            self._steps += 1
+            self._cond.notify_all()
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self.is_alive():
+            self.join()
+
+    def stats(self):
+        '''Returns the number of items sent, and the mean, maximum and
+        standard deviation (jitter) of their lateness in nanoseconds.
+
+        '''
+        if not self.sent:
+            return 0, 0, 0, 0
+        mean = float(self._late_sum) / self.sent
+        var = max(0.0, float(self._late_sq_sum) / self.sent - mean * mean)
+        return self.sent, mean, self.max_late, var ** 0.5
+
+    def run(self):
+        try:
+            while self._item is not None:
+                if not self._speed:
+                    due = None
+                elif self._period:
+                    due = int(self.sent * self._period / self._speed)
+                else:
+                    due = int((self._item[2] - self._first_time) /
+                            self._speed)
+                late = self._wait(due)
+                if late is None:
+                    return
+                if due is None:
+                    send_time = flexitime.now_ns()
+                else:
+                    send_time = self._wall_start + due
+                port_num, port_type, data_time, data = self._item
+                self._write_item(port_num, port_type, data_time, data,
+                        send_time - data_time)
+                self.sent += 1
+                self._late_sum += late
+                self._late_sq_sum += late * late
+                self.max_late = max(self.max_late, late)
+                self._item = self._read_item()
+        except:
+            print_exc()
+        self.finished = True
+
+    def _wait(self, due):
+        '''Waits until due nanoseconds after the start of playback, not
+        counting time spent paused. If due is None, only waits while paused.
+        Returns how late the wake up was, or None if playback is being stopped.
+
+        '''
+        while True:
+            with self._cond:
+                if self._paused and not self._stopping:
+                    pause_start = flexitime.monotonic_ns()
+                    while self._paused and not self._steps and \
+                            not self._stopping:
+                        self._cond.wait()
+                    if self._stopping:
+                        return None
+                    now = flexitime.monotonic_ns()
+                    if self._paused:
+                        # Stepping: send this item now, and carry on the
+                        # schedule from it
+                        self._steps -= 1
+                        if due is not None:
+                            self._shift(now - self._start_time - due)
+                        return 0
+                    self._shift(now - pause_start)
+                if self._stopping:
+                    return None
+            if due is None:
+                return 0
+            remaining = self._start_time + due - flexitime.monotonic_ns()
+            if remaining <= 0:
+                return -remaining
+            time.sleep(min(float(remaining) / flexitime.NSEC_PER_SEC,
+                self.max_sleep))
+
+    def _shift(self, delta):
+        # Moves the rest of the schedule later by delta nanoseconds
+        self._start_time += delta
+        self._wall_start += delta
+
+
 class FlexiLogger(OpenRTM_aist.DataFlowComponentBase):
     def __init__(self, mgr, abs_times=False, use_ctrl=False, ig_times=False,
             rate=0.0, file_name='', input=True, txt_mode=False, port_spec=[],
-            verb=0):
+            verb=0, binary=False, write_thread=False, queue_size=1024,
+            queue_policy='block', start_time=0.0, codec='none', speed=1.0,
+            step=False, play_ports=[], decimation=[], max_rates=[],
+            segment_size=0, segment_time=0.0, keep_segments=0,
+            pre_trigger=0.0, post_trigger=0.0, trigger_port=False,
+            buffer_depth=8):
         OpenRTM_aist.DataFlowComponentBase.__init__(self, mgr)
 
         try:
@@ -110,10 +375,36 @@ class FlexiLogger(OpenRTM_aist.DataFlowComponentBase):
             self._file_name = file_name
             self._input = input
             self._txt_mode = txt_mode
+            self._binary = binary
+            self._write_thread = write_thread
+            self._queue_size = queue_size
+            self._queue_policy = queue_policy
+            self._start_time = start_time
+            self._codec = codec
+            self._speed = speed
+            self._step = step
+            self._play_ports = play_ports
+            self._decimation = decimation
+            self._max_rates = max_rates
+            self._segment_size = segment_size
+            self._segment_time = segment_time
+            self._keep_segments = keep_segments
+            self._pre_trigger = pre_trigger
+            self._post_trigger = post_trigger
+            self._trigger_port = trigger_port
+            self._buffer = None
+            self._record_until = None
+            # Start and stop operations on the control port arrive on another
+            # thread, so in black box mode they are queued and carried out by
+            # onExecute, which owns the buffer and the writer
+            self._commands = collections.deque()
+            self._buffer_depth = buffer_depth
             self._port_spec = port_spec
             self._verb = verb
             self._log_file = None
-            self._next_item = None
+            self._writer = None
+            self._reader = None
+            self._scheduler = None
             self._logging = False
         except:
             print_exc()
@@ -128,32 +419,48 @@ class FlexiLogger(OpenRTM_aist.DataFlowComponentBase):
                 self._ctrl_port.registerProvider("BasicOperations",
                         "UI.BasicOperations", self._ctrl_impl)
                 self.addPort(self._ctrl_port)
-            else:
+            if not self._use_ctrl or (self._pre_trigger and self._input):
+                # In black box mode, samples are always collected, and the
+                # control port triggers writing them out instead
                 self._logging = True
 
             self._num_ports = 0
             self._ports = []
+            self._buffer_full = []
 
             self._open_log_file()
             if self._input:
-                if not self._txt_mode:
-                    if not self._pickle(self._port_spec):
-                        print >>sys.stderr, 'Error writing port configuration.'
-                        return RTC.RTC_ERROR
+                try:
+                    self._writer.write_header(self._port_spec)
+                except (IOError, pickle.PicklingError), e:
+                    print >>sys.stderr, \
+                            'Error writing port configuration: {0}'.format(e)
+                    return RTC.RTC_ERROR
                 port_type = OpenRTM_aist.InPort
                 reg_func = self.registerInPort
                 default_port_name = 'input'
             else:
-                file_ports = self._read_log_item()
+                try:
+                    file_ports = self._reader.read_header()
+                except logformat.LogFormatError, e:
+                    print >>sys.stderr, e
+                    file_ports = None
                 if not file_ports:
                     print >>sys.stderr, 'Error reading port configuration.'
                     return RTC.RTC_ERROR
                 self._port_spec = file_ports
+                if not self._set_up_port_filters():
+                    return RTC.RTC_ERROR
                 port_type = OpenRTM_aist.OutPort
                 reg_func = self.registerOutPort
                 default_port_name = 'output'
 
             for new_port in self._port_spec:
+                if not self._input and self._num_ports not in self._selected:
+                    # Not played back, so the port is not needed
+                    self._ports.append(None)
+                    self._num_ports += 1
+                    continue
                 if self._verb >= 3:
                     print >>sys.stderr, 'Adding port {0}'.format(new_port)
                 if new_port[2] == '':
@@ -169,12 +476,22 @@ class FlexiLogger(OpenRTM_aist.DataFlowComponentBase):
                     init_args = [None for ii in range(len(args) - 1)]
                 new_port_data = new_port[1](*init_args)
                 new_port_obj = port_type(port_name, new_port_data,
-                        OpenRTM_aist.RingBuffer(8))
+                        OpenRTM_aist.RingBuffer(self._buffer_depth))
                 reg_func(port_name, new_port_obj)
                 self._ports.append([new_port_data, new_port_obj])
+                self._buffer_full.append(0)
                 self._num_ports += 1
                 if self._verb >= 2:
                     print >>sys.stderr, 'Added port {0}'.format(new_port)
+            if self._input and self._pre_trigger:
+                self._buffer = PreTriggerBuffer(self._port_spec,
+                        flexitime.float_to_ns(self._pre_trigger))
+                if self._trigger_port:
+                    self._trigger_data = RTC.TimedBoolean(RTC.Time(0, 0),
+                            False)
+                    self._trigger_in = OpenRTM_aist.InPort('trigger',
+                            self._trigger_data, OpenRTM_aist.RingBuffer(8))
+                    self.registerInPort('trigger', self._trigger_in)
         except:
             print_exc()
             raise
@@ -186,17 +503,25 @@ class FlexiLogger(OpenRTM_aist.DataFlowComponentBase):
                 # Need to prepare the log file by reading out the first entry
                 # and calculating the time offset between current computer time
                 # and the time of that entry
-                self._next_item = self._read_log_item()
-                if self._next_item == None:
-                    print >>sys.stderr, 'Error getting first item from log file'
+                if self._start_time > 0:
+                    first_item = self._seek_log(self._start_time)
+                else:
+                    first_item = self._read_log_item()
+                if first_item == None:
+                    print >>sys.stderr, \
+                            'Error getting first item from log file'
                     return RTC.RTC_ERROR
-                self._offset = subtract_times(float_to_time(time.time()),
-                        self._next_item[2])
-                self._next_send_time = float_to_time(time.time())
+                if self._ig_times:
+                    period = flexitime.float_to_ns(self._rate)
+                else:
+                    period = None
+                self._scheduler = PlaybackScheduler(first_item,
+                        self._read_log_item, self._write_output_item, period,
+                        self._speed, paused=not self._logging or self._step)
                 if self._verb >= 1:
-                    print >>sys.stderr, \
-                            'Time offset is {0}.{1:09d}'.format(self._offset.sec,
-                                    self._offset.nsec)
+                    print >>sys.stderr, 'Time offset is {0}'.format(
+                            flexitime.format_ns(self._scheduler.offset))
+                self._scheduler.start()
         except IOError, e:
             print >>sys.stderr, 'Failed to open log file {0}'.format(e)
             return RTC.RTC_ERROR
@@ -207,6 +532,31 @@ class FlexiLogger(OpenRTM_aist.DataFlowComponentBase):
 
     def onDeactivated(self, ec_id):
         try:
+            if self._scheduler:
+                self._scheduler.stop()
+                if self._verb >= 1:
+                    sent, mean, max_late, jitter = self._scheduler.stats()
+                    print >>sys.stderr, 'Sent {0} samples; lateness mean \
+{1:.3f} ms, maximum {2:.3f} ms, jitter {3:.3f} ms'.format(sent, mean / 1e6,
+                            max_late / 1e6, jitter / 1e6)
+                self._scheduler = None
+            for ii, count in enumerate(self._buffer_full):
+                if count:
+                    print >>sys.stderr, 'Input port {0} buffer was found \
+full in {1} executions; samples may have been overwritten.'.format(ii, count)
+            if self._writer:
+                self._writer.close()
+                if self._write_thread and self._writer.lost:
+                    print >>sys.stderr, '{0} queued samples were lost after \
+an error writing the log.'.format(self._writer.lost)
+                if self._write_thread and self._verb >= 1:
+                    print >>sys.stderr, 'Queued {0} samples, dropped {1}, \
+maximum queue depth {2}'.format(self._writer.queued, self._writer.dropped,
+                            self._writer.max_depth)
+                self._writer = None
+            if self._reader:
+                self._reader.close()
+                self._reader = None
             if self._log_file:
                 self._log_file.close()
                 self._log_file = None
@@ -219,13 +569,15 @@ class FlexiLogger(OpenRTM_aist.DataFlowComponentBase):
 
     def onExecute(self, ec_id):
         try:
-            if self._logging:
-                if self._input:
-                    if not self._handle_input():
-                        return RTC.RTC_ERROR
-                else:
-                    if not self._do_output():
-                        return RTC.RTC_ERROR
+            if self._input:
+                if self._buffer:
+                    self._check_trigger()
+                if self._logging and not self._handle_input():
+                    return RTC.RTC_ERROR
+            elif self._scheduler and self._scheduler.finished:
+                # Playback is done by the scheduler thread, so there is only
+                # the end of the log to check for
+                return RTC.RTC_ERROR
         except:
             print_exc()
             raise
@@ -233,131 +585,253 @@ class FlexiLogger(OpenRTM_aist.DataFlowComponentBase):
 
     def _open_log_file(self):
         if self._input:
-            flags = 'wb'
             dir = 'output'
+            if self._segment_size or self._segment_time:
+                self._writer = logformat.SegmentedLogWriter(self._file_name,
+                        self._make_writer, self._segment_size,
+                        flexitime.float_to_ns(self._segment_time),
+                        self._keep_segments)
+                dir = 'output in segments'
+            else:
+                self._log_file = open(self._file_name, 'wb')
+                self._writer = self._make_writer(self._log_file)
+            if self._write_thread:
+                self._writer = AsyncLogWriter(self._writer, self._queue_size,
+                        self._queue_policy)
         else:
-            flags = 'rb'
             dir = 'input'
-        self._log_file = open(self._file_name, flags)
+            segments = None
+            if not os.path.exists(self._file_name):
+                segments = logformat.find_segments(self._file_name)
+            if segments:
+                # Play the segments of a log that was split into segments
+                self._reader = logformat.SegmentedLogReader(segments,
+                        read_ahead=4)
+                dir = 'input from {0} segments'.format(len(segments))
+            else:
+                self._log_file = open(self._file_name, 'rb')
+                self._reader = logformat.open_log_reader(self._log_file,
+                        mapped=True, read_ahead=4)
         if self._verb >= 1:
             print >>sys.stderr, 'Opened log file {0} for {1}'.format(
                     self._file_name, dir)
 
-    def _pickle(self, item):
+    def _make_writer(self, log_file):
+        if self._txt_mode:
+            return logformat.TextLogWriter(log_file)
+        elif self._binary:
+            return logformat.BinaryLogWriter(log_file,
+                    codec=logformat.codec_names[self._codec])
+        return logformat.PickleLogWriter(log_file)
+
+    def _write_log_item(self, port_num, port_type, data):
+        if 'tm' in dir(data):
+            data_time = flexitime.time_to_ns(data.tm)
+        else:
+            data_time = flexitime.now_ns()
+        if self._buffer and self._record_until is None:
+            # Waiting for a trigger
+            self._buffer.append(port_num, data_time, data)
+            return True
         try:
-            pickle.dump(item, self._log_file, pickle.HIGHEST_PROTOCOL)
+            self._writer.write(port_num, port_type, data_time, data)
+        except IOError, e:
+            print >>sys.stderr, 'Error writing to log file: {0}'.format(e)
+            return False
         except pickle.PicklingError, e:
             print >>sys.stderr, 'Error pickling data: {0}'.format(e)
             return False
         return True
 
-    def _write_log_item(self, port_num, port_type, data):
-        if 'tm' in dir(data):
-            data_time = data.tm
-        else:
-            data_time = RTC.tm
-            now = time.time()
-            data_time.sec = int(now)
-            data_time.nsec = int(now % 1 * 1e9)
-        if self._txt_mode:
+    def _check_trigger(self):
+        # Checks for a trigger from the control port or the trigger port, and
+        # for the end of the recording after a trigger
+        while self._commands:
+            if self._commands.popleft() == 'start':
+                self._trigger()
+            elif self._record_until is not None:
+                # End the recording after a trigger early
+                self._record_until = flexitime.now_ns()
+        if self._trigger_port:
+            while self._trigger_in.isNew():
+                if self._trigger_in.read().data:
+                    self._trigger()
+        if self._record_until is not None and \
+                flexitime.now_ns() >= self._record_until:
+            self._record_until = None
+            if self._verb >= 1:
+                print >>sys.stderr, 'Trigger recording finished.'
+
+    def _trigger(self):
+        '''Writes the samples in the pre-trigger buffer to the log, and logs
+        the samples received in the next post_trigger seconds. A trigger
+        during that time extends it.
+
+        '''
+        if self._record_until is None:
+            count = 0
             try:
-                self._log_file.write('{0}\t{1}\t{2}.{3:09d}\t{4}\n'.format(
-                    port_num, port_type, data_time.sec, data_time.nsec,
-                    str(data)))
-            except IOError, e:
+                for port_num, port_type, data_time, data in \
+                        self._buffer.flush():
+                    self._writer.write(port_num, port_type, data_time, data)
+                    count += 1
+            except (IOError, pickle.PicklingError), e:
                 print >>sys.stderr, 'Error writing to log file: {0}'.format(e)
-                return False
-            return True
-        else:
-            return self._pickle((port_num, port_type, data_time, data))
+            if self._verb >= 1:
+                print >>sys.stderr, 'Triggered; wrote {0} buffered \
+samples.'.format(count)
+        self._record_until = flexitime.now_ns() + \
+                flexitime.float_to_ns(self._post_trigger)
 
     def _read_log_item(self):
-        '''Gets the next log item from the log file and returns it unpickled as
-        a tuple: (port number, port type string, data time, data)
+        '''Gets the next log item to play from the log file and returns it as a
+        tuple: (port number, port type string, data time in nanoseconds, data)
+
+        '''
+        while True:
+            try:
+                log_item = self._reader.read_item()
+            except logformat.LogFormatError, e:
+                print >>sys.stderr, 'Error reading log file: {0}'.format(e)
+                return None
+            if log_item is None:
+                print >>sys.stderr, 'End of log file'
+                return None
+            if self._keep_item(log_item[0], log_item[2]):
+                return log_item
+
+    def _set_up_port_filters(self):
+        '''Works out which logged ports to play back, and the decimation and
+        maximum rate of each, from the port names or numbers given.
 
         '''
         try:
-            log_item = pickle.load(self._log_file)
-        except pickle.UnpicklingError, e:
-            print >>sys.stderr, 'Error unpickling data: {0}'.format(e)
-            return None
-        except EOFError:
-            print >>sys.stderr, 'End of log file'
-            return None
-        return log_item
+            if self._play_ports:
+                self._selected = set([find_log_port(self._port_spec, p) \
+                        for p in self._play_ports])
+                self._reader.select_ports(self._selected)
+            else:
+                self._selected = set(range(len(self._port_spec)))
+            self._keep_every = dict([(find_log_port(self._port_spec, p), n) \
+                    for p, n in self._decimation])
+            self._min_intervals = dict([(find_log_port(self._port_spec, p),
+                flexitime.float_to_ns(1.0 / r)) for p, r in self._max_rates])
+        except ValueError, e:
+            print >>sys.stderr, e
+            return False
+        self._play_counts = [0 for p in self._port_spec]
+        self._last_play_times = [None for p in self._port_spec]
+        return True
+
+    def _keep_item(self, port_num, data_time):
+        # Applies the decimation and maximum rate of the item's port
+        if port_num in self._keep_every:
+            count = self._play_counts[port_num]
+            self._play_counts[port_num] = count + 1
+            if count % self._keep_every[port_num]:
+                return False
+        if port_num in self._min_intervals:
+            last = self._last_play_times[port_num]
+            if last is not None and \
+                    data_time - last < self._min_intervals[port_num]:
+                return False
+            self._last_play_times[port_num] = data_time
+        return True
+
+    def _seek_log(self, start_time):
+        '''Moves playback to start_time seconds after the start of the log,
+        and returns the first item to play.
+
+        '''
+        if hasattr(self._reader, 'seek_time'):
+            seek_time = self._reader.start_time()
+            if seek_time is None:
+                return None
+            seek_time += flexitime.float_to_ns(start_time)
+            self._reader.seek_time(seek_time)
+            item = self._read_log_item()
+        else:
+            # No index, so read through the log to the start time
+            if self._verb >= 1:
+                print >>sys.stderr, 'Log file has no index; reading through \
+it to the start time.'
+            item = self._read_log_item()
+            if item is None:
+                return None
+            seek_time = item[2] + flexitime.float_to_ns(start_time)
+            while item is not None and item[2] < seek_time:
+                item = self._read_log_item()
+        if self._verb >= 1:
+            print >>sys.stderr, 'Starting playback at {0}'.format(
+                    flexitime.format_ns(seek_time))
+        return item
 
     def _handle_input(self):
         for ii in range(self._num_ports):
-            if self._ports[ii][1].isNew():
-                data = self._ports[ii][1].read()
+            port = self._ports[ii][1]
+            # Read everything in the port's buffer, but no more, so that a
+            # port receiving data as fast as it is read cannot hold up the
+            # other ports
+            count = 0
+            while count < self._buffer_depth and port.isNew():
+                data = port.read()
+                count += 1
                 if self._verb >= 3:
                     print >>sys.stderr, \
                             'Input port {0} has new data: {1}'.format(ii,
                                     str(data))
                 elif self._verb == 2:
-                    print >>sys.stderr, 'Input port %d has new data.'
+                    print >>sys.stderr, \
+                            'Input port {0} has new data.'.format(ii)
                 if not self._write_log_item(ii, self._port_spec[ii][0], data):
                     return False
+            if count == self._buffer_depth:
+                # The buffer was full, so older samples may have been
+                # overwritten before they could be read. The port does not
+                # say how many, or whether any were, so only the executions
+                # that found the buffer full are counted.
+                self._buffer_full[ii] += 1
         return True
 
-    def _do_output(self):
-        if self._next_item == None:
-            return False
-        if self._ig_times:
-            # Get the current time
-            current_time = float_to_time(time.time())
-            # If the current time is past the last send time + 1/rate, send
-            # another item
-            if compare_times(self._next_send_time, current_time) <= 0:
-                self._write_output_item(*self._next_item)
-                # Get the next item from the log file
-                self._next_item = self._read_log_item()
-                # Calculate the next time to send
-                self._next_send_time = add_times(self._next_send_time,
-                        float_to_time(playback_rate))
-                if self._next_item == None:
-                    return False
-        else:
-            # Get the current time
-            current_time = subtract_times(float_to_time(time.time()),
-                    self._offset)
-            # Pull entries from the log and send them until the next log
-            # entry's time is greater than the current time (or we run out of
-            # entries)
-            while self._next_item is not None and \
-                    compare_times(self._next_item[2], current_time) <= 0:
-                self._write_output_item(*self._next_item)
-                self._next_item = self._read_log_item()
-                if self._next_item == None:
-                    return False
-            if self._verb >= 3:
-                print >>sys.stderr, \
-                        'Caught up: {0}.{1:09d} < {2}.{3:09d}'.format(
-                        current_time.sec, current_time.nsec,
-                        self._next_item[2].sec, self._next_item[2].nsec)
-        return True
-
-
-    def _write_output_item(self, port_num, port_typeStr, data_time, data):
+    def _write_output_item(self, port_num, port_typeStr, data_time, data,
+            offset):
         if not self._abs_times:
-            data_time = add_times(data_time, self._offset)
+            data_time += offset
+            if 'tm' in dir(data):
+                flexitime.ns_to_time(data_time, data.tm)
         self._ports[port_num][1].write(data)
         if self._verb >= 3:
             print >>sys.stderr, \
-                    'Wrote log entry with time {0}.{1:09d} to port {2}: {3}'.format(
-                    data_time.sec, data_time.nsec, port_num, str(data))
+                    'Wrote log entry with time {0} to port {1}: {2}'.format(
+                    flexitime.format_ns(data_time), port_num, str(data))
         elif self._verb == 2:
             print >>sys.stderr, \
-                    'Wrote log entry with time {0}.{1:09d} to port {2}'.format(
-                    data_time.sec, data_time.nsec, port_num, str(data))
+                    'Wrote log entry with time {0} to port {1}'.format(
+                    flexitime.format_ns(data_time), port_num)
 
     def _start(self):
+        if self._buffer:
+            self._commands.append('start')
+            return
+        if self._step and not self._input:
+            if self._scheduler:
+                self._scheduler.step()
+            if self._verb >= 1:
+                print >>sys.stderr, 'Playback stepped manually.'
+            return
         self._logging = True
+        if self._scheduler:
+            self._scheduler.resume()
         if self._verb >= 1:
             print >>sys.stderr, 'Logging enabled manually.'
 
     def _stop(self):
+        if self._buffer:
+            self._commands.append('stop')
+            return
         self._logging = False
+        if self._scheduler:
+            self._scheduler.pause()
         if self._verb >= 1:
             print >>sys.stderr, 'Logging disabled manually.'
 
@@ -376,6 +850,24 @@ def find_port_type(type_name):
     return types[0][1]
 
 
+def find_log_port(port_spec, port):
+    '''Finds the number of a logged port from its name or number.'''
+    if port.isdigit() and int(port) < len(port_spec):
+        return int(port)
+    for ii, p in enumerate(port_spec):
+        if p[2] == port:
+            return ii
+    raise ValueError('No port named "{0}" in the log'.format(port))
+
+
+def parse_port_value(option, value_type):
+    # Splits a port:value option into the port and the value
+    port, sep, value = option.rpartition(':')
+    if not sep or not port:
+        raise ValueError
+    return port, value_type(value)
+
+
 def get_options():
     try:
         usage = 'Usage: %prog [options]\nSave data received on specified \
@@ -386,10 +878,21 @@ specified ports.'
                 action='store_true', default=False,
                 help='Times from the log file are sent as absolute, rather \
 than adjusted for current time. [Default: %default]')
+        parser.add_option('-b', '--binary', dest='binary', action='store_true',
+                default=False,
+                help='Log data in the binary format, storing the data of each \
+port in typed columns. Much smaller and faster than the default pickle format \
+for numeric and string ports. The format of a log file is detected \
+automatically in output mode. [Default: %default]')
         parser.add_option('-c', '--use_control', dest='use_control',
                 action='store_true', default=False,
                 help='Use a control port to enable/disable logging/playback \
 when the component is active. [Default: %default]')
+        parser.add_option('-d', '--buffer_depth', dest='buffer_depth',
+                type='int', default=8, help='Number of samples each input \
+port can buffer between executions. All buffered samples are logged each \
+execution. The number of executions that find a buffer full is printed on \
+deactivation. [Default: %default]')
         parser.add_option('-g', '--ignore_times', dest='ignore_times',
                 type='float', action='store', default=-1,
                 help='Ignore times in the log file during playback and play \
@@ -409,10 +912,61 @@ will be named automatically.')
         parser.add_option('-o', '--output', dest='input', action='store_false',
                 help='Ports are output ports, read data from log file and \
 send. Opposite of --input.')
+        parser.add_option('--play_port', dest='play_ports', type='string',
+                action='append', default=[],
+                help='Name or number of a logged port to play back. Samples \
+of other ports are skipped without being decoded where the log format allows. \
+Multiple ports can be specified with multiple occurances of this option. \
+[Default: all ports]')
+        parser.add_option('--decimate', dest='decimation', type='string',
+                action='append', default=[],
+                help='Play back only every Nth sample of a logged port, given \
+as port:N, where port is the port\'s name or number. [Default: none]')
+        parser.add_option('--max_rate', dest='max_rates', type='string',
+                action='append', default=[],
+                help='Limit the rate of playback of a logged port, given as \
+port:rate, where rate is in Hertz of log time. Samples closer together than \
+this are skipped. [Default: none]')
         parser.add_option('-p', '--port', dest='ports', type='string',
                 action='append', default=[],
                 help='Port type. Multiple ports can be specified with \
 multiple occurances of this option.')
+        parser.add_option('--pre_trigger', dest='pre_trigger', type='float',
+                default=0.0, help='Black box mode: keep the samples received \
+in the last this many seconds in memory, and only write them to the log when \
+triggered by a start operation on the control port or by a true value on the \
+trigger port. [Default: off]')
+        parser.add_option('--post_trigger', dest='post_trigger',
+                type='float', default=10.0, help='Seconds of samples to log \
+after a trigger in black box mode. [Default: %default]')
+        parser.add_option('--trigger_port', dest='trigger_port',
+                action='store_true', default=False, help='Add a TimedBoolean \
+input port named "trigger" for triggering in black box mode. \
+[Default: %default]')
+        parser.add_option('-r', '--speed', dest='speed', type='float',
+                default=1.0, help='Playback speed, as a multiple of the speed \
+the data was logged at (or of the --ignore_times rate). 0 plays back as fast \
+as possible. [Default: %default]')
+        parser.add_option('-s', '--start_time', dest='start_time',
+                type='float', default=0.0,
+                help='Start playback this many seconds after the start of \
+the log. Binary logs are indexed, so the start point is found directly; other \
+logs are read through to it. [Default: %default]')
+        parser.add_option('--step', dest='step', action='store_true',
+                default=False, help='Step through playback one sample at a \
+time: each start operation on the control port sends the next sample. \
+Requires --use_control. [Default: %default]')
+        parser.add_option('--segment_size', dest='segment_size',
+                type='float', default=0, help='Split the log into segment \
+files of about this many megabytes. Segments are named by numbering the log \
+file name, such as logger.0000.log. In output mode, a log that was split into \
+segments is played back by giving its log file name. [Default: no limit]')
+        parser.add_option('--segment_time', dest='segment_time',
+                type='float', default=0, help='Split the log into segment \
+files holding this many seconds of data each. [Default: no limit]')
+        parser.add_option('--keep_segments', dest='keep_segments', type='int',
+                default=0, help='Delete the oldest segments of the log so that \
+only this many are kept. [Default: keep all]')
         parser.add_option('-t', '--text', dest='text_mode',
                 action='store_true', default=False,
                 help='Log data in human-readable text format. WARNING: log \
@@ -421,6 +975,24 @@ output mode. [Default: %default]')
         parser.add_option('-v', '--verbosity', dest='verbosity', type='int',
                 default=0, help='Verbosity level (higher numbers give more \
 output). [Default: %default]')
+        parser.add_option('-w', '--write_thread', dest='write_thread',
+                action='store_true', default=False,
+                help='Write the log file from a separate thread, so that slow \
+disk writes do not stall the execution context. [Default: %default]')
+        parser.add_option('--queue_size', dest='queue_size', type='int',
+                default=1024, help='Number of samples that can be queued for \
+the write thread. [Default: %default]')
+        parser.add_option('--queue_policy', dest='queue_policy',
+                type='choice', choices=['block', 'drop_oldest', 'drop_newest'],
+                default='block', help='What to do with a new sample when the \
+write thread\'s queue is full: block until there is space, drop the oldest \
+queued sample, or drop the new sample. [Default: %default]')
+        parser.add_option('-z', '--compress', dest='codec', type='choice',
+                choices=logformat.codec_names.keys(), default='none',
+                help='Compress the blocks of a binary log with the given \
+codec: none, zlib, bz2 or lzma (lzma requires the backports.lzma module). \
+Compressed logs are detected automatically in output mode. \
+[Default: %default]')
         parser.add_option('-f', dest='config_file', type='string', default='',
                 help='OpenRTM option; ignored by the component.')
         options, args = parser.parse_args()
@@ -430,6 +1002,52 @@ output). [Default: %default]')
 
     if not options.input and options.text_mode:
         parser.error('Text mode is not compatible with output mode.')
+    if options.binary and options.text_mode:
+        parser.error('Text mode is not compatible with binary mode.')
+    if options.codec != 'none':
+        if not options.binary:
+            parser.error('Compression requires binary mode.')
+        if logformat.codec_names[options.codec] not in logformat.compressors:
+            parser.error('Codec {0} is not available.'.format(options.codec))
+    if options.speed < 0:
+        parser.error('Playback speed cannot be negative.')
+    if options.step and not options.use_control:
+        parser.error('Stepped playback requires the control port.')
+    if options.input and (options.play_ports or options.decimation or \
+            options.max_rates):
+        parser.error('Port playback options require output mode.')
+    try:
+        options.decimation = [parse_port_value(d, int) \
+                for d in options.decimation]
+        options.max_rates = [parse_port_value(r, float) \
+                for r in options.max_rates]
+    except ValueError:
+        parser.error('Port playback options must be given as port:value.')
+    if [n for p, n in options.decimation if n < 1] or \
+            [r for p, r in options.max_rates if r <= 0]:
+        parser.error('Decimation and maximum rates must be positive.')
+    if options.segment_size < 0 or options.segment_time < 0 or \
+            options.keep_segments < 0:
+        parser.error('Segment limits cannot be negative.')
+    if options.keep_segments and not (options.segment_size or \
+            options.segment_time):
+        parser.error('Keeping segments requires a segment size or time.')
+    if not options.input and (options.segment_size or options.segment_time):
+        parser.error('Segment limits only apply in input mode.')
+    if options.pre_trigger < 0 or options.post_trigger < 0:
+        parser.error('Trigger times cannot be negative.')
+    if options.pre_trigger:
+        if not options.input:
+            parser.error('Black box mode requires input mode.')
+        if not options.use_control and not options.trigger_port:
+            parser.error('Black box mode requires the control port or the \
+trigger port.')
+    elif options.trigger_port:
+        parser.error('The trigger port requires black box mode.')
+    if options.buffer_depth < 1:
+        parser.error('Buffer depth must be at least 1.')
+    if options.queue_size < 1:
+        parser.error('Queue size must be at least 1.')
     if not options.ports and options.input:
         parser.error('Must specify at least one port')
     port_names = options.port_names.split(',')
@@ -469,7 +1087,13 @@ def comp_fact(opts):
         return FlexiLogger(mgr, opts.abs_times, opts.use_control,
                 opts.ignore_times != -1, 1.0 / opts.ignore_times,
                 opts.log_file, opts.input, opts.text_mode, opts.ports,
-                opts.verbosity)
+                opts.verbosity, opts.binary, opts.write_thread,
+                opts.queue_size, opts.queue_policy, opts.start_time,
+                opts.codec, opts.speed, opts.step, opts.play_ports,
+                opts.decimation, opts.max_rates,
+                int(opts.segment_size * 1024 * 1024), opts.segment_time,
+                opts.keep_segments, opts.pre_trigger, opts.post_trigger,
+                opts.trigger_port, opts.buffer_depth)
     return fact_fun
 
 
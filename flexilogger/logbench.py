@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''flexicomps
+
+Copyright (C) 2008-2010
+    Geoffrey Biggs
+    RT-Synthesis Research Group
+    Intelligent Systems Research Institute,
+    National Institute of Advanced Industrial Science and Technology (AIST),
+    Japan
+    All rights reserved.
+Licensed under the Eclipse Public License -v 1.0 (EPL)
+http://www.opensource.org/licenses/eclipse-1.0.txt
+
+File: logbench.py
+
+Benchmark of the FlexiLogger log formats and codecs. Synthetic data for some
+typical port types is written to and played back from a temporary log file
+with each available codec, and the size and throughput of each are printed.
+
+'''
+
+import math
+import optparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+import RTC
+
+import logformat
+
+
+def make_double(ii):
+    # A slowly-varying sensor value
+    return RTC.TimedDouble(RTC.Time(0, 0),
+            math.sin(ii / 100.0) + random.gauss(0, 0.01))
+
+
+def make_long_seq(ii):
+    # Encoder counts from six joints
+    return RTC.TimedLongSeq(RTC.Time(0, 0),
+            [ii * (jj + 1) + random.randint(-2, 2) for jj in range(6)])
+
+
+def make_double_seq(ii):
+    # A 1080-point laser scan, with ranges to the millimetre
+    return RTC.TimedDoubleSeq(RTC.Time(0, 0),
+            [round(2.0 + math.sin(jj / 50.0 + ii / 20.0) +
+                random.gauss(0, 0.005), 3) for jj in range(1080)])
+
+
+def make_octet_seq(ii):
+    # A 320x240 greyscale image
+    return RTC.TimedOctetSeq(RTC.Time(0, 0),
+            ''.join([chr((x + y + ii + random.randint(0, 3)) % 256)
+                for y in range(240) for x in range(320)]))
+
+
+port_types = [
+    ('TimedDouble', RTC.TimedDouble, make_double, 1.0),
+    ('TimedLongSeq', RTC.TimedLongSeq, make_long_seq, 1.0),
+    ('TimedDoubleSeq', RTC.TimedDoubleSeq, make_double_seq, 0.2),
+    ('TimedOctetSeq', RTC.TimedOctetSeq, make_octet_seq, 0.05),
+]
+
+
+def bench(type_name, port_class, samples, codec, block_size):
+    '''Writes and reads back the samples. Returns the size of the log, and
+    the time taken to write and read it.
+
+    '''
+    fd, path = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+    try:
+        port_spec = [(type_name, port_class, '')]
+        with open(path, 'wb') as f:
+            start = time.time()
+            if codec is None:
+                writer = logformat.PickleLogWriter(f)
+            else:
+                writer = logformat.BinaryLogWriter(f, block_size, codec)
+            writer.write_header(port_spec)
+            for ii, data in enumerate(samples):
+                writer.write(0, type_name, ii * 1000000, data)
+            writer.close()
+            write_time = time.time() - start
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            start = time.time()
+            reader = logformat.open_log_reader(f, mapped=True, read_ahead=4)
+            reader.read_header()
+            while reader.read_item() is not None:
+                pass
+            reader.close()
+            read_time = time.time() - start
+    finally:
+        os.remove(path)
+    return size, write_time, read_time
+
+
+def get_options():
+    usage = 'Usage: %prog [options]\nBenchmark the FlexiLogger log formats \
+and codecs.'
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-b', '--block_size', dest='block_size', type='int',
+            default=logformat.DEFAULT_BLOCK_SIZE,
+            help='Samples per block. [Default: %default]')
+    parser.add_option('-n', '--samples', dest='samples', type='int',
+            default=2000, help='Number of samples of the smallest port \
+types. Larger types use fewer samples. [Default: %default]')
+    options, args = parser.parse_args()
+    return options
+
+
+def main():
+    options = get_options()
+    codecs = [('pickle', None)] + sorted([(name, codec) for name, codec in \
+            logformat.codec_names.items() if codec == logformat.CODEC_NONE or \
+            codec in logformat.compressors], key=lambda c: c[1])
+    print '{0:<16}{1:<8}{2:>8}{3:>12}{4:>8}{5:>12}{6:>12}'.format('Port type',
+            'Codec', 'Samples', 'Size (kB)', 'Ratio', 'Write/s', 'Read/s')
+    for type_name, port_class, make_sample, scale in port_types:
+        random.seed(0)
+        count = max(1, int(options.samples * scale))
+        samples = [make_sample(ii) for ii in range(count)]
+        pickle_size = None
+        for codec_name, codec in codecs:
+            size, write_time, read_time = bench(type_name, port_class,
+                    samples, codec, options.block_size)
+            if pickle_size is None:
+                pickle_size = size
+            print '{0:<16}{1:<8}{2:>8}{3:>12.1f}{4:>8.2f}{5:>12.0f}\
+{6:>12.0f}'.format(type_name, codec_name, count, size / 1024.0,
+                    float(pickle_size) / size, count / write_time,
+                    count / read_time)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
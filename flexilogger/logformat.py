@@ -0,0 +1,1147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''flexicomps
+
+Copyright (C) 2008-2010
+    Geoffrey Biggs
+    RT-Synthesis Research Group
+    Intelligent Systems Research Institute,
+    National Institute of Advanced Industrial Science and Technology (AIST),
+    Japan
+    All rights reserved.
+Licensed under the Eclipse Public License -v 1.0 (EPL)
+http://www.opensource.org/licenses/eclipse-1.0.txt
+
+File: logformat.py
+
+Log file formats for the FlexiLogger component.
+
+Three formats are supported:
+
+ - Pickle (format version 0): the pickled port specification followed by one
+   pickled (port number, port type, time, data) tuple per sample.
+ - Text: one line per sample. Cannot be read back.
+ - Binary (format version 1): a fixed-width file header and the pickled port
+   specification, followed by blocks. Each block holds one chunk per port that
+   received data while the block was filled, and each chunk stores its samples
+   as columns: the sample times, then the values packed as typed arrays for
+   numeric and string ports, or pickled for any other type. When the log is
+   closed, an index of the blocks is appended, giving the offset, time range
+   and cumulative per-port sample counts of each block, followed by a trailer
+   pointing to the index. The contents of each block can be compressed
+   with zlib, bz2 or (if available) lzma; the block headers and the index are
+   never compressed, so compressed logs can still be indexed and seeked.
+
+A log can also be split into a series of segment files, each of which is a
+complete log in one of the above formats.
+
+All times passed to and returned from the writers and readers are integer
+nanoseconds.
+
+'''
+
+import array
+import bisect
+import bz2
+import collections
+import cPickle as pickle
+import mmap
+from operator import itemgetter
+import os
+import Queue
+import re
+import struct
+import sys
+import threading
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# The modules shared between components are kept in the common directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir, 'common'))
+import flexitime
+
+
+FORMAT_PICKLE = 0
+FORMAT_BINARY = 1
+
+FILE_MAGIC = 'FXLG'
+BLOCK_MAGIC = 'FXBK'
+INDEX_MAGIC = 'FXIX'
+TRAILER_MAGIC = 'FXTR'
+
+# Magic, format version, flags, length of the pickled port spec that follows
+FILE_HEADER = struct.Struct('<4sHHI')
+# Magic, codec, number of chunks, stored length, raw length, first time, last
+# time
+BLOCK_HEADER = struct.Struct('<4sHHIIqq')
+# Port number, encoding, array type code, number of samples, payload length
+CHUNK_HEADER = struct.Struct('<HBcII')
+# Magic, number of entries
+INDEX_HEADER = struct.Struct('<4sI')
+# Block offset, first time, last time (followed by one cumulative sample count
+# per port)
+INDEX_ENTRY = struct.Struct('<Qqq')
+# Magic, index offset
+TRAILER = struct.Struct('<4sQ')
+
+FLAG_BIG_ENDIAN = 0x0001
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_BZ2 = 2
+CODEC_LZMA = 3
+
+codec_names = {
+    'none':     CODEC_NONE,
+    'zlib':     CODEC_ZLIB,
+    'bz2':      CODEC_BZ2,
+    'lzma':     CODEC_LZMA,
+}
+
+compressors = {
+    CODEC_ZLIB:     zlib.compress,
+    CODEC_BZ2:      bz2.compress,
+}
+
+decompressors = {
+    CODEC_ZLIB:     zlib.decompress,
+    CODEC_BZ2:      bz2.decompress,
+}
+
+if lzma:
+    compressors[CODEC_LZMA] = lzma.compress
+    decompressors[CODEC_LZMA] = lzma.decompress
+
+# Chunk payload encodings. Every payload starts with the sample times as
+# little-endian 64-bit integers.
+ENC_PICKLE = 0  # A pickled list of the data objects
+ENC_SCALAR = 1  # An array of the values
+ENC_SEQ = 2     # An array of the sequence lengths, then all the elements
+ENC_BYTES = 3   # An array of the string lengths, then the strings
+
+# Array type codes for the port types stored as typed columns
+type_codes = {
+    'TimedShort':       'h',
+    'TimedLong':        'i',
+    'TimedUShort':      'H',
+    'TimedULong':       'I',
+    'TimedFloat':       'f',
+    'TimedDouble':      'd',
+    'TimedShortSeq':    'h',
+    'TimedLongSeq':     'i',
+    'TimedUShortSeq':   'H',
+    'TimedULongSeq':    'I',
+    'TimedFloatSeq':    'f',
+    'TimedDoubleSeq':   'd',
+}
+
+# Port types whose data is a string
+byte_types = ['TimedString', 'TimedCharSeq', 'TimedOctetSeq']
+
+DEFAULT_BLOCK_SIZE = 256
+
+
+class LogFormatError(Exception):
+    pass
+
+
+def port_encoding(type_name):
+    '''Gets the chunk encoding and array type code used for a port type.'''
+    if type_name in type_codes:
+        if type_name.endswith('Seq'):
+            return ENC_SEQ, type_codes[type_name]
+        return ENC_SCALAR, type_codes[type_name]
+    elif type_name in byte_types:
+        return ENC_BYTES, 'B'
+    return ENC_PICKLE, 'x'
+
+
+def decompress_block(codec, stored):
+    if codec == CODEC_NONE:
+        return stored
+    if codec not in decompressors:
+        raise LogFormatError('Unsupported block codec {0}'.format(codec))
+    return decompressors[codec](stored)
+
+
+def pack_times(times):
+    return struct.pack('<{0}q'.format(len(times)), *times)
+
+
+def unpack_times(buf, offset, count):
+    return struct.unpack_from('<{0}q'.format(count), buf, offset)
+
+
+class PickleLogWriter(object):
+    def __init__(self, log_file):
+        self._file = log_file
+
+    def write_header(self, port_spec):
+        pickle.dump(port_spec, self._file, pickle.HIGHEST_PROTOCOL)
+
+    def write(self, port_num, port_type, data_time, data):
+        pickle.dump((port_num, port_type, flexitime.ns_to_time(data_time),
+            data), self._file, pickle.HIGHEST_PROTOCOL)
+
+    def close(self):
+        self._file.flush()
+
+
+class TextLogWriter(object):
+    def __init__(self, log_file):
+        self._file = log_file
+
+    def write_header(self, port_spec):
+        pass
+
+    def write(self, port_num, port_type, data_time, data):
+        self._file.write('{0}\t{1}\t{2}\t{3}\n'.format(port_num, port_type,
+            flexitime.format_ns(data_time), str(data)))
+
+    def close(self):
+        self._file.flush()
+
+
+class Column(object):
+    '''Samples received on one port, waiting to be written as a chunk.'''
+    def __init__(self, port_num, type_name):
+        self.port_num = port_num
+        self.encoding, self.type_code = port_encoding(type_name)
+        self.clear()
+
+    def clear(self):
+        self.times = []
+        if self.encoding == ENC_SCALAR or self.encoding == ENC_SEQ:
+            self.values = array.array(self.type_code)
+        else:
+            self.values = []
+        self.lengths = array.array('I')
+
+    def append(self, data_time, data):
+        self.times.append(data_time)
+        if self.encoding == ENC_SCALAR:
+            self.values.append(data.data)
+        elif self.encoding == ENC_SEQ:
+            self.lengths.append(len(data.data))
+            self.values.extend(data.data)
+        elif self.encoding == ENC_BYTES:
+            self.lengths.append(len(data.data))
+            self.values.append(data.data)
+        else:
+            self.values.append(data)
+
+    def encode(self):
+        parts = [pack_times(self.times)]
+        if self.encoding == ENC_SCALAR:
+            parts.append(self.values.tostring())
+        elif self.encoding == ENC_SEQ:
+            parts.append(self.lengths.tostring())
+            parts.append(self.values.tostring())
+        elif self.encoding == ENC_BYTES:
+            parts.append(self.lengths.tostring())
+            parts += self.values
+        else:
+            parts.append(pickle.dumps(self.values, pickle.HIGHEST_PROTOCOL))
+        payload = ''.join(parts)
+        return CHUNK_HEADER.pack(self.port_num, self.encoding,
+                self.type_code, len(self.times), len(payload)) + payload
+
+
+class IndexEntry(object):
+    def __init__(self, offset, first_time, last_time, counts):
+        self.offset = offset            # File offset of the block
+        self.first_time = first_time    # Time of the block's oldest sample
+        self.last_time = last_time      # Time of the block's newest sample
+        self.counts = counts            # Samples per port up to and including
+                                        # the block
+
+
+def pack_index(entries, num_ports):
+    entry_counts = struct.Struct('<{0}I'.format(num_ports))
+    parts = [INDEX_HEADER.pack(INDEX_MAGIC, len(entries))]
+    for e in entries:
+        parts.append(INDEX_ENTRY.pack(e.offset, e.first_time, e.last_time))
+        parts.append(entry_counts.pack(*e.counts))
+    return ''.join(parts)
+
+
+def unpack_index(buf, num_ports):
+    entry_counts = struct.Struct('<{0}I'.format(num_ports))
+    magic, num_entries = INDEX_HEADER.unpack_from(buf, 0)
+    if magic != INDEX_MAGIC:
+        raise LogFormatError('Bad index header')
+    entries = []
+    offset = INDEX_HEADER.size
+    for ii in range(num_entries):
+        block_offset, first_time, last_time = \
+                INDEX_ENTRY.unpack_from(buf, offset)
+        offset += INDEX_ENTRY.size
+        counts = list(entry_counts.unpack_from(buf, offset))
+        offset += entry_counts.size
+        entries.append(IndexEntry(block_offset, first_time, last_time, counts))
+    return entries
+
+
+class BinaryLogWriter(object):
+    def __init__(self, log_file, block_size=DEFAULT_BLOCK_SIZE,
+            codec=CODEC_NONE):
+        self._file = log_file
+        self._block_size = block_size
+        self._codec = codec
+        self._columns = []
+        self._count = 0
+        self._first_time = 0
+        self._last_time = 0
+        self._index = []
+        self._port_counts = []
+
+    def write_header(self, port_spec):
+        self._columns = [Column(ii, p[0]) for ii, p in enumerate(port_spec)]
+        self._port_counts = [0 for p in port_spec]
+        spec = pickle.dumps(port_spec, pickle.HIGHEST_PROTOCOL)
+        if sys.byteorder == 'big':
+            flags = FLAG_BIG_ENDIAN
+        else:
+            flags = 0
+        self._file.write(FILE_HEADER.pack(FILE_MAGIC, FORMAT_BINARY, flags,
+            len(spec)))
+        self._file.write(spec)
+
+    def write(self, port_num, port_type, data_time, data):
+        if self._count == 0:
+            self._first_time = data_time
+            self._last_time = data_time
+        elif data_time < self._first_time:
+            self._first_time = data_time
+        elif data_time > self._last_time:
+            self._last_time = data_time
+        self._columns[port_num].append(data_time, data)
+        self._count += 1
+        if self._count >= self._block_size:
+            self.write_block()
+
+    def write_block(self):
+        if self._count == 0:
+            return
+        chunks = [c.encode() for c in self._columns if c.times]
+        raw = ''.join(chunks)
+        for c in self._columns:
+            self._port_counts[c.port_num] += len(c.times)
+        self._index.append(IndexEntry(self._file.tell(), self._first_time,
+            self._last_time, self._port_counts[:]))
+        if self._codec == CODEC_NONE:
+            stored = raw
+        else:
+            stored = compressors[self._codec](raw)
+        self._file.write(BLOCK_HEADER.pack(BLOCK_MAGIC, self._codec,
+            len(chunks), len(stored), len(raw), self._first_time,
+            self._last_time))
+        self._file.write(stored)
+        for c in self._columns:
+            c.clear()
+        self._count = 0
+
+    def close(self):
+        self.write_block()
+        index_offset = self._file.tell()
+        self._file.write(pack_index(self._index, len(self._columns)))
+        self._file.write(TRAILER.pack(TRAILER_MAGIC, index_offset))
+        self._file.flush()
+
+
+class Chunk(object):
+    '''The decoded columns of one chunk.'''
+    def __init__(self, port_num, encoding, type_code, times, lengths,
+            values):
+        self.port_num = port_num
+        self.encoding = encoding
+        self.type_code = type_code
+        self.times = times
+        self.lengths = lengths
+        self.values = values
+
+    def samples(self):
+        '''Returns a list of (time, value) pairs for the chunk's samples.'''
+        if self.encoding == ENC_SCALAR or self.encoding == ENC_PICKLE:
+            return zip(self.times, self.values)
+        result = []
+        start = 0
+        for t, length in zip(self.times, self.lengths):
+            result.append((t, self.values[start:start + length]))
+            start += length
+        if self.encoding == ENC_SEQ:
+            result = [(t, v.tolist()) for t, v in result]
+        return result
+
+
+def decode_chunk(buf, offset, swap):
+    '''Decodes the chunk at offset in buf. Returns the chunk and the offset of
+    the following chunk.
+
+    '''
+    port_num, encoding, type_code, count, length = \
+            CHUNK_HEADER.unpack_from(buf, offset)
+    offset += CHUNK_HEADER.size
+    end = offset + length
+    times = unpack_times(buf, offset, count)
+    offset += count * 8
+    lengths = None
+    if encoding == ENC_SCALAR:
+        values = array.array(type_code)
+        values.fromstring(buf[offset:end])
+    elif encoding == ENC_SEQ or encoding == ENC_BYTES:
+        lengths = array.array('I')
+        lengths.fromstring(buf[offset:offset + count * lengths.itemsize])
+        offset += count * lengths.itemsize
+        if encoding == ENC_SEQ:
+            values = array.array(type_code)
+            values.fromstring(buf[offset:end])
+        else:
+            values = buf[offset:end]
+    elif encoding == ENC_PICKLE:
+        values = pickle.loads(buf[offset:end])
+    else:
+        raise LogFormatError('Unknown chunk encoding {0}'.format(encoding))
+    if swap:
+        if lengths is not None:
+            lengths.byteswap()
+        if isinstance(values, array.array):
+            values.byteswap()
+    return Chunk(port_num, encoding, type_code, times, lengths, values), end
+
+
+def make_items(chunks, port_spec):
+    '''Makes the samples of some decoded chunks into a list of (port number,
+    port type string, data time, data) items, in time order.
+
+    '''
+    items = []
+    for c in chunks:
+        port_type, port_class = port_spec[c.port_num][:2]
+        if c.encoding == ENC_PICKLE:
+            items += [(c.port_num, port_type, t, v) for t, v in c.samples()]
+        else:
+            items += [(c.port_num, port_type, t,
+                port_class(flexitime.ns_to_time(t), v))
+                for t, v in c.samples()]
+    items.sort(key=itemgetter(2))
+    return items
+
+
+def unpack_block_header(buf, offset):
+    '''Unpacks the block header at offset in buf. Returns None if there are
+    no more blocks.
+
+    '''
+    if buf[offset:offset + len(INDEX_MAGIC)] == INDEX_MAGIC:
+        return None
+    if len(buf) - offset < BLOCK_HEADER.size:
+        return None
+    header = BLOCK_HEADER.unpack_from(buf, offset)
+    if header[0] != BLOCK_MAGIC:
+        raise LogFormatError('Bad block header')
+    return header
+
+
+class PickleLogReader(object):
+    format_version = FORMAT_PICKLE
+
+    def __init__(self, log_file):
+        self._file = log_file
+        self._ports = None
+        self.port_spec = None
+
+    def read_header(self):
+        self.port_spec = self._unpickle()
+        return self.port_spec
+
+    def select_ports(self, ports):
+        '''Limits reading to the samples of the given port numbers. Pickled
+        items are not length-prefixed, so the other samples are still unpickled
+        to get past them.
+
+        '''
+        self._ports = frozenset(ports)
+
+    def read_item(self):
+        '''Returns the next item as a tuple: (port number, port type string,
+        data time, data), or None at the end of the log.
+
+        '''
+        while True:
+            item = self._unpickle()
+            if item is None:
+                return None
+            port_num, port_type, data_time, data = item
+            if self._ports is None or port_num in self._ports:
+                return port_num, port_type, flexitime.time_to_ns(data_time), \
+                        data
+
+    def close(self):
+        pass
+
+    def _unpickle(self):
+        try:
+            return pickle.load(self._file)
+        except EOFError:
+            return None
+        except pickle.UnpicklingError, e:
+            raise LogFormatError('Error unpickling data: {0}'.format(e))
+
+
+class BinaryLogReader(object):
+    format_version = FORMAT_BINARY
+
+    def __init__(self, log_file):
+        self._file = log_file
+        self._swap = False
+        self._items = []
+        self._index = None
+        self._data_offset = 0
+        self._skip_before = None
+        self._ports = None
+        self._skip_blocks = frozenset()
+        self.port_spec = None
+
+    def read_header(self):
+        header = self._file.read(FILE_HEADER.size)
+        if len(header) < FILE_HEADER.size:
+            raise LogFormatError('Truncated file header')
+        magic, version, flags, spec_len = FILE_HEADER.unpack(header)
+        if magic != FILE_MAGIC:
+            raise LogFormatError('Not a binary log file')
+        if version != FORMAT_BINARY:
+            raise LogFormatError(
+                    'Unsupported log format version {0}'.format(version))
+        self._swap = bool(flags & FLAG_BIG_ENDIAN) != \
+                (sys.byteorder == 'big')
+        self.port_spec = pickle.loads(self._file.read(spec_len))
+        self._data_offset = self._file.tell()
+        return self.port_spec
+
+    def index(self):
+        '''Gets the index of the log's blocks. If the log has no index (because
+        the logger did not close it), the index is built by scanning the block
+        headers.
+
+        '''
+        if self._index is None:
+            position = self._file.tell()
+            try:
+                self._index = self._read_index()
+                if self._index is None:
+                    self._index = self._scan_index()
+            finally:
+                self._file.seek(position)
+        return self._index
+
+    def start_time(self):
+        index = self.index()
+        if not index:
+            return None
+        return min(e.first_time for e in index)
+
+    def sample_counts(self):
+        '''Gets the number of samples logged on each port.'''
+        index = self.index()
+        if not index:
+            return [0 for p in self.port_spec]
+        return index[-1].counts[:]
+
+    def select_ports(self, ports):
+        '''Limits reading to the samples of the given port numbers. The chunks
+        of other ports are skipped without being decoded, and blocks with no
+        samples from the given ports (found from the index) are not read or
+        decompressed at all. Call before reading any items.
+
+        '''
+        self._ports = frozenset(ports)
+        skip = set()
+        previous = [0 for p in self.port_spec]
+        for e in self.index():
+            if not [p for p in self._ports if e.counts[p] != previous[p]]:
+                skip.add(e.offset)
+            previous = e.counts
+        self._skip_blocks = frozenset(skip)
+
+    def seek_time(self, seek_time):
+        '''Moves the reader to the first block that may contain samples at or
+        after seek_time. Samples in that block before seek_time are skipped.
+
+        '''
+        index = self.index()
+        # Block times may overlap, so search the running maximum of the last
+        # times to find the first block that can hold the time
+        newest = []
+        for e in index:
+            if newest:
+                newest.append(max(newest[-1], e.last_time))
+            else:
+                newest.append(e.last_time)
+        ii = bisect.bisect_left(newest, seek_time)
+        if ii == len(index):
+            self._seek_block(None)
+        else:
+            self._seek_block(index[ii].offset)
+        self._skip_before = seek_time
+
+    def _seek_block(self, offset):
+        # Moves to the block at offset, or to the end of the blocks if offset
+        # is None
+        if offset is None:
+            self._file.seek(0, os.SEEK_END)
+        else:
+            self._file.seek(offset)
+        self._items = []
+
+    def _read_index(self):
+        self._file.seek(0, os.SEEK_END)
+        trailer_offset = self._file.tell() - TRAILER.size
+        if trailer_offset < self._data_offset:
+            return None
+        self._file.seek(trailer_offset)
+        magic, index_offset = TRAILER.unpack(self._file.read(TRAILER.size))
+        if magic != TRAILER_MAGIC:
+            return None
+        self._file.seek(index_offset)
+        return unpack_index(self._file.read(trailer_offset - index_offset),
+                len(self.port_spec))
+
+    def _scan_index(self):
+        index = []
+        counts = [0 for p in self.port_spec]
+        self._file.seek(self._data_offset)
+        while True:
+            offset = self._file.tell()
+            header = self._file.read(BLOCK_HEADER.size)
+            if len(header) < BLOCK_HEADER.size or \
+                    header[:len(BLOCK_MAGIC)] != BLOCK_MAGIC:
+                break
+            magic, codec, num_chunks, stored_len, raw_len, first_time, \
+                    last_time = BLOCK_HEADER.unpack(header)
+            body = self._file.read(stored_len)
+            if len(body) < stored_len:
+                break
+            body = decompress_block(codec, body)
+            chunk_offset = 0
+            for ii in range(num_chunks):
+                port_num, encoding, type_code, count, length = \
+                        CHUNK_HEADER.unpack_from(body, chunk_offset)
+                counts[port_num] += count
+                chunk_offset += CHUNK_HEADER.size + length
+            index.append(IndexEntry(offset, first_time, last_time, counts[:]))
+        return index
+
+    def read_block(self):
+        '''Reads the next block and returns its decoded chunks, or None at the
+        end of the log.
+
+        '''
+        while True:
+            block_offset = self._file.tell()
+            header = unpack_block_header(self._file.read(BLOCK_HEADER.size),
+                    0)
+            if header is None:
+                return None
+            magic, codec, num_chunks, stored_len, raw_len, first_time, \
+                    last_time = header
+            if block_offset in self._skip_blocks:
+                self._file.seek(stored_len, os.SEEK_CUR)
+                continue
+            raw = self._file.read(stored_len)
+            if len(raw) < stored_len:
+                # The logger stopped part way through writing this block
+                return None
+            raw = decompress_block(codec, raw)
+            chunks = []
+            offset = 0
+            for ii in range(num_chunks):
+                offset, wanted = self._check_chunk(raw, offset)
+                if wanted:
+                    chunk, offset = decode_chunk(raw, offset, self._swap)
+                    chunks.append(chunk)
+            return chunks
+
+    def read_item(self):
+        '''Returns the next item as a tuple: (port number, port type string,
+        data time, data), or None at the end of the log.
+
+        '''
+        while not self._items:
+            chunks = self.read_block()
+            if chunks is None:
+                return None
+            # Reverse the items so they can be popped off the end
+            self._items = make_items(chunks, self.port_spec)
+            self._items.reverse()
+            if self._skip_before is not None:
+                while self._items and self._items[-1][2] < self._skip_before:
+                    self._items.pop()
+                self._skip_before = None
+        return self._items.pop()
+
+    def close(self):
+        pass
+
+    def _check_chunk(self, buf, offset):
+        # Checks if the chunk at offset is from a selected port. Returns the
+        # offset of the chunk if it is, or of the next chunk if it is not,
+        # and whether it is.
+        if self._ports is None:
+            return offset, True
+        port_num, encoding, type_code, count, length = \
+                CHUNK_HEADER.unpack_from(buf, offset)
+        if port_num in self._ports:
+            return offset, True
+        return offset + CHUNK_HEADER.size + length, False
+
+
+class MappedChunk(object):
+    '''A chunk in a memory-mapped log. Sample values are decoded directly from
+    the mapped buffer when they are requested.
+
+    '''
+    def __init__(self, buf, offset, swap):
+        self.port_num, self.encoding, type_code, count, length = \
+                CHUNK_HEADER.unpack_from(buf, offset)
+        offset += CHUNK_HEADER.size
+        self.end = offset + length
+        self.times = unpack_times(buf, offset, count)
+        offset += count * 8
+        self._buf = buf
+        self._type_code = type_code
+        self._swap = swap
+        if self.encoding == ENC_SCALAR:
+            self._values = array.array(type_code)
+            self._values.fromstring(buffer(buf, offset, self.end - offset))
+            if swap:
+                self._values.byteswap()
+        elif self.encoding == ENC_SEQ or self.encoding == ENC_BYTES:
+            lengths = array.array('I')
+            lengths.fromstring(buffer(buf, offset, count * lengths.itemsize))
+            if swap:
+                lengths.byteswap()
+            offset += count * lengths.itemsize
+            if self.encoding == ENC_SEQ:
+                item_size = array.array(type_code).itemsize
+            else:
+                item_size = 1
+            # Byte offset and size of each sample's values
+            self._spans = []
+            for l in lengths:
+                self._spans.append((offset, l * item_size))
+                offset += l * item_size
+        elif self.encoding == ENC_PICKLE:
+            self._values = pickle.loads(buf[offset:self.end])
+        else:
+            raise LogFormatError(
+                    'Unknown chunk encoding {0}'.format(self.encoding))
+
+    def value(self, ii):
+        if self.encoding == ENC_SEQ:
+            start, size = self._spans[ii]
+            values = array.array(self._type_code)
+            values.fromstring(buffer(self._buf, start, size))
+            if self._swap:
+                values.byteswap()
+            return values.tolist()
+        elif self.encoding == ENC_BYTES:
+            start, size = self._spans[ii]
+            return self._buf[start:start + size]
+        return self._values[ii]
+
+
+class BlockPrefetcher(threading.Thread):
+    '''Reads and decompresses the blocks of a mapped log ahead of playback,
+    starting from a given offset. Blocks are passed to the reader through a
+    bounded queue as (block header, decompressed block contents, offset of the
+    next block) tuples, with None marking the end of the blocks. Blocks at the
+    offsets in skip_blocks are passed over.
+
+    '''
+    def __init__(self, log_map, offset, depth, skip_blocks=frozenset()):
+        threading.Thread.__init__(self, name='FlexiLogger read-ahead')
+        self.daemon = True
+        self._map = log_map
+        self._offset = offset
+        self._skip_blocks = skip_blocks
+        self._queue = Queue.Queue(depth)
+        self._stopping = threading.Event()
+        self.start()
+
+    def next_block(self):
+        block = self._queue.get()
+        if isinstance(block, Exception):
+            raise block
+        return block
+
+    def stop(self):
+        self._stopping.set()
+        # Unblock the thread if it is waiting for space in the queue
+        try:
+            while True:
+                self._queue.get_nowait()
+        except Queue.Empty:
+            pass
+        self.join()
+
+    def run(self):
+        offset = self._offset
+        while not self._stopping.is_set():
+            try:
+                header = unpack_block_header(self._map, offset)
+                if header is not None:
+                    codec, stored_len = header[1], header[3]
+                    start = offset + BLOCK_HEADER.size
+                    if start + stored_len > len(self._map):
+                        header = None
+                if header is None:
+                    block = None
+                elif offset in self._skip_blocks:
+                    offset = start + stored_len
+                    continue
+                else:
+                    offset = start + stored_len
+                    block = (header, decompress_block(codec,
+                        self._map[start:offset]), offset)
+            except Exception, e:
+                block = e
+            while not self._stopping.is_set():
+                try:
+                    self._queue.put(block, timeout=0.1)
+                    break
+                except Queue.Full:
+                    pass
+            if block is None or isinstance(block, Exception):
+                return
+
+
+class MappedLogReader(BinaryLogReader):
+    '''A binary log reader that memory-maps the log file. Samples are decoded
+    straight from the map as they are read, and the data of typed ports is
+    placed in one data object per port that is reused for every sample. The
+    data returned by read_item() is therefore only valid until the next item
+    from the same port is read.
+
+    If the blocks are compressed and read_ahead is greater than zero, a
+    separate thread decompresses up to that many blocks ahead of playback.
+
+    '''
+    def __init__(self, log_file, read_ahead=0):
+        BinaryLogReader.__init__(self, log_file)
+        self._map = mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._pos = 0
+        self._port_data = []
+        self._read_ahead = read_ahead
+        self._prefetcher = None
+
+    def read_header(self):
+        BinaryLogReader.read_header(self)
+        self._pos = self._data_offset
+        self._port_data = []
+        for type_name, port_class in [p[:2] for p in self.port_spec]:
+            if port_encoding(type_name)[0] == ENC_PICKLE:
+                self._port_data.append(None)
+            else:
+                self._port_data.append(port_class(flexitime.ns_to_time(0),
+                    None))
+        header = unpack_block_header(self._map, self._pos)
+        if self._read_ahead > 0 and header is not None and \
+                header[1] != CODEC_NONE:
+            self._prefetcher = BlockPrefetcher(self._map, self._pos,
+                    self._read_ahead, self._skip_blocks)
+        return self.port_spec
+
+    def select_ports(self, ports):
+        BinaryLogReader.select_ports(self, ports)
+        if self._prefetcher:
+            # Restart read-ahead so that it passes over the skipped blocks
+            self._seek_block(self._pos)
+
+    def read_item(self):
+        while not self._items:
+            if not self._map_block():
+                return None
+            if self._skip_before is not None:
+                while self._items and self._items[-1][0] < self._skip_before:
+                    self._items.pop()
+                self._skip_before = None
+        data_time, order, chunk, ii = self._items.pop()
+        port_num = chunk.port_num
+        data = self._port_data[port_num]
+        if data is None:
+            data = chunk.value(ii)
+        else:
+            flexitime.ns_to_time(data_time, data.tm)
+            data.data = chunk.value(ii)
+        return port_num, self.port_spec[port_num][0], data_time, data
+
+    def close(self):
+        if self._prefetcher:
+            self._prefetcher.stop()
+            self._prefetcher = None
+        self._map.close()
+
+    def _map_block(self):
+        if self._prefetcher:
+            block = self._prefetcher.next_block()
+            if block is None:
+                return False
+            header, buf, self._pos = block
+            offset = 0
+        else:
+            while True:
+                header = unpack_block_header(self._map, self._pos)
+                if header is None:
+                    return False
+                offset = self._pos + BLOCK_HEADER.size
+                stored_len = header[3]
+                if offset + stored_len > len(self._map):
+                    # The logger stopped part way through writing this block
+                    return False
+                skip = self._pos in self._skip_blocks
+                self._pos = offset + stored_len
+                if not skip:
+                    break
+            if header[1] == CODEC_NONE:
+                buf = self._map
+            else:
+                buf = decompress_block(header[1],
+                        self._map[offset:self._pos])
+                offset = 0
+        # Order the block's samples by time, and reverse them so they can be
+        # popped off the end
+        items = []
+        for ii in range(header[2]):
+            offset, wanted = self._check_chunk(buf, offset)
+            if not wanted:
+                continue
+            chunk = MappedChunk(buf, offset, self._swap)
+            offset = chunk.end
+            items += [(t, len(items) + jj, chunk, jj)
+                    for jj, t in enumerate(chunk.times)]
+        items.sort()
+        items.reverse()
+        self._items = items
+        return True
+
+    def _seek_block(self, offset):
+        if offset is None:
+            self._pos = len(self._map)
+        else:
+            self._pos = offset
+        self._items = []
+        if self._prefetcher:
+            self._prefetcher.stop()
+            self._prefetcher = BlockPrefetcher(self._map, self._pos,
+                    self._read_ahead, self._skip_blocks)
+
+
+def open_log_reader(log_file, mapped=False, read_ahead=0):
+    '''Creates a reader for the format of an open log file, identified from
+    the file header. If mapped is True, binary logs are read through a memory
+    map, and compressed blocks are decompressed up to read_ahead blocks ahead
+    by a separate thread.
+
+    '''
+    magic = log_file.read(len(FILE_MAGIC))
+    log_file.seek(0)
+    if magic == FILE_MAGIC:
+        if mapped:
+            try:
+                return MappedLogReader(log_file, read_ahead)
+            except (EnvironmentError, ValueError):
+                # Not a file that can be mapped
+                pass
+        return BinaryLogReader(log_file)
+    return PickleLogReader(log_file)
+
+
+def segment_name(file_name, number):
+    '''Gets the name of a segment of a log, by numbering the log file name.
+    For example, segment 3 of logger.log is logger.0003.log.
+
+    '''
+    root, ext = os.path.splitext(file_name)
+    return '{0}.{1:04d}{2}'.format(root, number, ext)
+
+
+def find_segments(file_name):
+    '''Finds the existing segment files of a log, in order.'''
+    directory, base = os.path.split(file_name)
+    root, ext = os.path.splitext(base)
+    pattern = re.compile(re.escape(root) + r'\.(\d+)' + re.escape(ext) + '$')
+    segments = []
+    for name in os.listdir(directory or os.curdir):
+        match = pattern.match(name)
+        if match:
+            segments.append((int(match.group(1)),
+                os.path.join(directory, name)))
+    return [name for number, name in sorted(segments)]
+
+
+class SegmentedLogWriter(object):
+    '''Writes a log as a series of segment files, named by segment_name().
+    A new segment is started when the current one reaches max_size bytes, or
+    holds samples covering max_time nanoseconds. Each segment is written by a
+    writer made by make_writer(file) and starts with its own header, so it can
+    be read on its own. If keep is not zero, only the newest keep segments are
+    kept. Any existing segments of the log are replaced.
+
+    '''
+    def __init__(self, file_name, make_writer, max_size=0, max_time=0,
+            keep=0):
+        self._file_name = file_name
+        self._make_writer = make_writer
+        self._max_size = max_size
+        self._max_time = max_time
+        self._keep = keep
+        self._port_spec = None
+        self._number = 0
+        self._segments = collections.deque()
+        self._file = None
+        self._writer = None
+        self._first_time = None
+
+    def write_header(self, port_spec):
+        self._port_spec = port_spec
+        for name in find_segments(self._file_name):
+            os.remove(name)
+        self._open_segment()
+
+    def write(self, port_num, port_type, data_time, data):
+        if self._first_time is None:
+            self._first_time = data_time
+        elif (self._max_size and self._file.tell() >= self._max_size) or \
+                (self._max_time and \
+                data_time - self._first_time >= self._max_time):
+            self._close_segment()
+            self._open_segment()
+            self._first_time = data_time
+        self._writer.write(port_num, port_type, data_time, data)
+
+    def close(self):
+        self._close_segment()
+
+    def _open_segment(self):
+        name = segment_name(self._file_name, self._number)
+        self._number += 1
+        self._file = open(name, 'wb')
+        self._writer = self._make_writer(self._file)
+        self._writer.write_header(self._port_spec)
+        self._segments.append(name)
+        while self._keep and len(self._segments) > self._keep:
+            os.remove(self._segments.popleft())
+
+    def _close_segment(self):
+        if self._writer:
+            self._writer.close()
+            self._file.close()
+            self._writer = None
+            self._file = None
+
+
+class SegmentedLogReader(object):
+    '''Reads a series of segment files as one log. Each segment is read with
+    the reader returned by open_log_reader().
+
+    '''
+    def __init__(self, segments, read_ahead=0):
+        self._segments = list(segments)
+        self._read_ahead = read_ahead
+        self._next = 0
+        self._file = None
+        self._reader = None
+        self._ports = None
+        # An item read ahead while finding the start or seeking
+        self._pending = None
+        self.port_spec = None
+
+    def read_header(self):
+        self._open_next()
+        return self.port_spec
+
+    def select_ports(self, ports):
+        self._ports = ports
+        if self._reader:
+            self._reader.select_ports(ports)
+
+    def start_time(self):
+        if hasattr(self._reader, 'start_time'):
+            return self._reader.start_time()
+        if self._pending is None:
+            self._pending = self.read_item()
+        if self._pending is None:
+            return None
+        return self._pending[2]
+
+    def seek_time(self, seek_time):
+        '''Moves the reader to the first segment that may contain samples at
+        or after seek_time, and seeks within it.
+
+        '''
+        self._pending = None
+        while self._reader is not None:
+            if not hasattr(self._reader, 'seek_time'):
+                # No index, so read through to the time
+                item = self.read_item()
+                while item is not None and item[2] < seek_time:
+                    item = self.read_item()
+                self._pending = item
+                return
+            index = self._reader.index()
+            if index and max(e.last_time for e in index) >= seek_time:
+                self._reader.seek_time(seek_time)
+                return
+            self._open_next()
+
+    def read_item(self):
+        if self._pending is not None:
+            item, self._pending = self._pending, None
+            return item
+        while self._reader is not None:
+            item = self._reader.read_item()
+            if item is not None:
+                return item
+            self._open_next()
+        return None
+
+    def close(self):
+        self._close_segment()
+
+    def _open_next(self):
+        # Moves on to the next segment, if there is one
+        self._close_segment()
+        if self._next >= len(self._segments):
+            return
+        name = self._segments[self._next]
+        self._next += 1
+        self._file = open(name, 'rb')
+        self._reader = open_log_reader(self._file, mapped=True,
+                read_ahead=self._read_ahead)
+        port_spec = self._reader.read_header()
+        if not port_spec:
+            raise LogFormatError('Segment {0} has no header'.format(name))
+        if self.port_spec is None:
+            self.port_spec = port_spec
+        elif [p[0] for p in port_spec] != [p[0] for p in self.port_spec]:
+            raise LogFormatError(
+                    'Segment {0} has different ports to the log'.format(name))
+        if self._ports is not None:
+            self._reader.select_ports(self._ports)
+
+    def _close_segment(self):
+        if self._reader:
+            self._reader.close()
+            self._file.close()
+            self._reader = None
+            self._file = None
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''flexicomps
+
+Copyright (C) 2008-2010
+    Geoffrey Biggs
+    RT-Synthesis Research Group
+    Intelligent Systems Research Institute,
+    National Institute of Advanced Industrial Science and Technology (AIST),
+    Japan
+    All rights reserved.
+Licensed under the Eclipse Public License -v 1.0 (EPL)
+http://www.opensource.org/licenses/eclipse-1.0.txt
+
+File: logtool.py
+
+Command-line tool for FlexiLogger log files. Converts logs between the pickle,
+binary and text formats, cuts out a time range or a set of ports, and merges
+several logs into one in time order. No manager is needed.
+
+Logs are streamed through a pipeline of generators, one item at a time, so
+memory use does not depend on the size of the logs.
+
+'''
+
+import heapq
+import itertools
+import optparse
+import os
+import sys
+
+# The modules shared between components are kept in the common directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir, 'common'))
+import flexitime
+import logformat
+
+
+def read_items(reader):
+    '''Generates the items of a log.'''
+    while True:
+        item = reader.read_item()
+        if item is None:
+            return
+        yield item
+
+
+def first_time(reader, items):
+    '''Gets the time of the first sample of a log. Returns the time and the
+    items, which may have had to be read from to find it.
+
+    '''
+    if hasattr(reader, 'start_time'):
+        return reader.start_time(), items
+    try:
+        item = items.next()
+    except StopIteration:
+        return None, items
+    return item[2], itertools.chain([item], items)
+
+
+def slice_times(items, start, end):
+    '''Filters out items with times outside [start, end).'''
+    for item in items:
+        if (start is None or item[2] >= start) and \
+                (end is None or item[2] < end):
+            yield item
+
+
+def renumber_ports(items, port_map):
+    '''Changes the port number of each item to port_map[port number], and
+    filters out items of ports that map to None.
+
+    '''
+    for port_num, port_type, data_time, data in items:
+        new_num = port_map[port_num]
+        if new_num is not None:
+            yield new_num, port_type, data_time, data
+
+
+def merge_items(streams):
+    '''Merges several time-ordered item streams into one. Only the next item
+    of each stream is held at a time. Items with equal times are taken from the
+    earlier stream first, and keep their order within a stream.
+
+    '''
+    def decorate(ii, items):
+        for jj, item in enumerate(items):
+            yield item[2], ii, jj, item
+    decorated = [decorate(ii, items) for ii, items in enumerate(streams)]
+    for data_time, ii, jj, item in heapq.merge(*decorated):
+        yield item
+
+
+def select_ports(port_spec, selected):
+    '''Makes a map from port numbers in port_spec to port numbers in the
+    output, keeping the ports in selected (names or numbers), or all ports if
+    selected is empty.
+
+    '''
+    if not selected:
+        return range(len(port_spec))
+    keep = set()
+    for port in selected:
+        if port.isdigit() and int(port) < len(port_spec):
+            keep.add(int(port))
+            continue
+        matches = [ii for ii, p in enumerate(port_spec) if p[2] == port]
+        if not matches:
+            raise ValueError('No port named "{0}"'.format(port))
+        keep.update(matches)
+    port_map = []
+    count = 0
+    for ii in range(len(port_spec)):
+        if ii in keep:
+            port_map.append(count)
+            count += 1
+        else:
+            port_map.append(None)
+    return port_map
+
+
+def make_writer(out_file, out_format, codec, block_size):
+    if out_format == 'text':
+        return logformat.TextLogWriter(out_file)
+    elif out_format == 'binary':
+        return logformat.BinaryLogWriter(out_file, block_size,
+                logformat.codec_names[codec])
+    return logformat.PickleLogWriter(out_file)
+
+
+def get_options():
+    usage = 'Usage: %prog [options] log file...\nConvert, slice and merge \
+FlexiLogger log files. Multiple log files are merged by time.'
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-b', '--block_size', dest='block_size', type='int',
+            default=logformat.DEFAULT_BLOCK_SIZE,
+            help='Samples per block of a binary log. [Default: %default]')
+    parser.add_option('-e', '--end_time', dest='end_time', type='float',
+            default=None, help='Leave out samples from this many seconds \
+after the start of the earliest log. [Default: the end of the logs]')
+    parser.add_option('-f', '--format', dest='format', type='choice',
+            choices=['pickle', 'binary', 'text'], default='binary',
+            help='Format of the output log: pickle, binary or text. \
+[Default: %default]')
+    parser.add_option('-o', '--output', dest='output', type='string',
+            default='-', help='Output log file. Logs in text and pickle \
+format can be written to standard output. [Default: %default]')
+    parser.add_option('-p', '--port', dest='ports', type='string',
+            action='append', default=[], help='Name or number of a port to \
+keep. Ports of merged logs are numbered in the order of the logs. Multiple \
+ports can be specified with multiple occurances of this option. \
+[Default: all ports]')
+    parser.add_option('-s', '--start_time', dest='start_time', type='float',
+            default=None, help='Leave out samples from before this many \
+seconds after the start of the earliest log. [Default: the start of the \
+logs]')
+    parser.add_option('-v', '--verbosity', dest='verbosity', type='int',
+            default=0, help='Verbosity level (higher numbers give more \
+output). [Default: %default]')
+    parser.add_option('-z', '--compress', dest='codec', type='choice',
+            choices=logformat.codec_names.keys(), default='none',
+            help='Compress the blocks of a binary log with the given \
+codec: none, zlib, bz2 or lzma. [Default: %default]')
+    options, args = parser.parse_args()
+    if not args:
+        parser.error('Must specify at least one log file.')
+    if options.codec != 'none':
+        if options.format != 'binary':
+            parser.error('Compression requires the binary format.')
+        if logformat.codec_names[options.codec] not in logformat.compressors:
+            parser.error('Codec {0} is not available.'.format(options.codec))
+    if options.format == 'binary' and options.output == '-':
+        parser.error('Binary logs cannot be written to standard output.')
+    if options.block_size < 1:
+        parser.error('Block size must be at least 1.')
+    return options, args
+
+
+def main():
+    options, args = get_options()
+    in_files = []
+    readers = []
+    try:
+        port_spec = []
+        streams = []
+        start_times = []
+        for file_name in args:
+            in_file = open(file_name, 'rb')
+            in_files.append(in_file)
+            reader = logformat.open_log_reader(in_file, mapped=True)
+            readers.append(reader)
+            spec = reader.read_header()
+            # Number the ports of each log after those of the logs before it
+            port_map = range(len(port_spec), len(port_spec) + len(spec))
+            port_spec += spec
+            start, items = first_time(reader, read_items(reader))
+            if start is not None:
+                start_times.append(start)
+            streams.append((reader, renumber_ports(items, port_map)))
+        if not start_times:
+            print >>sys.stderr, 'The logs are empty.'
+            return 1
+
+        start = end = None
+        if options.start_time is not None:
+            start = min(start_times) + \
+                    flexitime.float_to_ns(options.start_time)
+        if options.end_time is not None:
+            end = min(start_times) + flexitime.float_to_ns(options.end_time)
+        sliced = []
+        for reader, items in streams:
+            if start is not None and hasattr(reader, 'seek_time'):
+                # Skip straight to the start time using the index. Nothing has
+                # been read from an indexed log yet, so nothing is lost.
+                reader.seek_time(start)
+            sliced.append(slice_times(items, start, end))
+        if len(sliced) == 1:
+            items = sliced[0]
+        else:
+            items = merge_items(sliced)
+
+        try:
+            port_map = select_ports(port_spec, options.ports)
+        except ValueError, e:
+            print >>sys.stderr, e
+            return 1
+        items = renumber_ports(items, port_map)
+        out_spec = [p for ii, p in enumerate(port_spec) \
+                if port_map[ii] is not None]
+
+        if options.output == '-':
+            out_file = sys.stdout
+        else:
+            out_file = open(options.output, 'wb')
+        try:
+            writer = make_writer(out_file, options.format, options.codec,
+                    options.block_size)
+            writer.write_header(out_spec)
+            count = 0
+            for port_num, port_type, data_time, data in items:
+                writer.write(port_num, port_type, data_time, data)
+                count += 1
+            writer.close()
+        finally:
+            if out_file is not sys.stdout:
+                out_file.close()
+        if options.verbosity >= 1:
+            print >>sys.stderr, 'Wrote {0} samples on {1} ports'.format(count,
+                    len(out_spec))
+    except (IOError, logformat.LogFormatError), e:
+        print >>sys.stderr, e
+        return 1
+    finally:
+        for reader in readers:
+            reader.close()
+        for in_file in in_files:
+            in_file.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())